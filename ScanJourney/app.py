@@ -1,11 +1,28 @@
-from flask import Flask, render_template, request, jsonify, session, url_for, redirect
+from flask import Flask, render_template, request, jsonify, session, url_for, redirect, send_from_directory, send_file, abort, Response, stream_with_context
 import os
+import time
 from datetime import datetime
 import json
+from contextlib import contextmanager
 from utils.image_analyzer import ImageAnalyzer
 from utils.metadata_manager import MetadataManager
+from utils.sqlite_metadata_store import SqliteMetadataStore
 from utils.gui_chat_manager import launch_gui_chat
-from openai import OpenAI
+from utils.thumbnail_generator import ThumbnailGenerator
+from utils.image_preprocessor import ImagePreprocessor
+from utils.speech_pipeline import SpeechPipeline
+from utils.tts_cache import TTSCache
+from utils.geo_cache import GeoCache, image_hash
+from utils.job_queue import JobQueue
+from utils.chat_store import ChatStore
+from utils.context_manager import ContextManager, provider_summarizer
+from utils.providers import create_provider
+from utils.openai_client import ProviderBusyError
+from utils.prompts import guide_chat_messages, usage_tracker, STREAM_USAGE_OPTIONS
+from utils.audio_transcoder import AudioTranscoder, AudioCompressionJob, audio_extension, audio_mimetype
+from utils.capture_ids import new_capture_id, atomic_target, atomic_write
+from utils.media_store import MediaStore, migrate_flat_uploads
+from utils.media_backends import create_media_backend, content_type
 from dotenv import load_dotenv
 
 os.environ["PYTHONIOENCODING"] = "utf-8"
@@ -17,11 +34,129 @@ app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key')
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# メディアファイルの送信を前段のWebサーバーに任せる（x-sendfile: Apache / lighttpd、x-accel: nginx）
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', 'none')
+# nginx で internal にした location（alias でメディアの保存先のディレクトリを指す）
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media/')
+app.config['USE_X_SENDFILE'] = MEDIA_SENDFILE == 'x-sendfile'
+# 内容ハッシュを名前に含むファイルをキャッシュさせる期間（1年）
+MEDIA_MAX_AGE = 31536000
 
 # 初期化
-openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-image_analyzer = ImageAnalyzer(openai_client)
-metadata_manager = MetadataManager('static/uploads/metadata.json')
+tts_cache = TTSCache(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'tts_cache'),
+    max_bytes=int(os.environ.get('TTS_CACHE_MAX_MB', 200)) * 1024 * 1024
+)
+# LLM・音声合成の呼び出し先（LLM_PROVIDER=fake でネットワークを使わない応答に切り替える）
+provider = create_provider(tts_cache=tts_cache)
+# チャットの会話はサーバー側に保存し、セッションには会話IDだけを持たせる
+chat_store = ChatStore(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'chat.db'),
+    max_conversations=int(os.environ.get('CHAT_CACHE_MAX', 1000)),
+    ttl=int(os.environ.get('CHAT_CACHE_TTL', 30 * 60))
+)
+# 長い会話でも1ターンで送るトークン数を一定に保つ（古いやり取りは要約して送る）
+chat_context_manager = ContextManager(
+    budget=int(os.environ.get('CHAT_CONTEXT_TOKENS', 3000)),
+    summarizer=provider_summarizer(provider)
+)
+# 音声合成APIの出力形式（mp3 / aac / opus など）
+TTS_FORMAT = os.environ.get('TTS_FORMAT', 'mp3')
+AUDIO_EXTENSION = audio_extension(TTS_FORMAT)
+speech_pipeline = SpeechPipeline(
+    provider,
+    max_workers=int(os.environ.get('TTS_MAX_WORKERS', 3)),
+    response_format=TTS_FORMAT
+)
+image_analyzer = ImageAnalyzer(
+    provider,
+    mode=os.environ.get('ANALYSIS_MODE', 'structured'),
+    speech_pipeline=speech_pipeline
+)
+# メタデータの保存先（METADATA_BACKEND=json で従来のJSONファイルを使用）
+if os.environ.get('METADATA_BACKEND', 'sqlite') == 'sqlite':
+    metadata_manager = MetadataManager(
+        'static/uploads/metadata.json',
+        store=SqliteMetadataStore('static/uploads/metadata.db', json_file='static/uploads/metadata.json')
+    )
+else:
+    metadata_manager = MetadataManager('static/uploads/metadata.json')
+# 撮影の画像・音声・サムネイルは内容ハッシュをキーに保存し、同じ内容は1つにまとめる
+# （MEDIA_BACKEND=s3 で S3 互換のオブジェクトストレージに保存し、複数のサーバーで共有する）
+media_store = MediaStore(
+    app.config['UPLOAD_FOLDER'],
+    backend=create_media_backend(os.path.join(app.config['UPLOAD_FOLDER'], 'media'), '/media')
+)
+thumbnail_generator = ThumbnailGenerator(app.config['UPLOAD_FOLDER'], store=media_store)
+# 近くで撮影された似た画像があれば、その分析結果を再利用する（GEO_CACHE_RADIUS_M=0 で無効）
+geo_cache = GeoCache(
+    metadata_manager,
+    media_store,
+    radius_m=float(os.environ.get('GEO_CACHE_RADIUS_M', 50)),
+    max_hash_distance=int(os.environ.get('GEO_CACHE_MAX_HASH_DISTANCE', 10))
+)
+image_preprocessor = ImagePreprocessor(
+    max_edge=int(os.environ.get('VISION_MAX_EDGE', 2048)),
+    max_short_edge=int(os.environ.get('VISION_MAX_SHORT_EDGE', 768)),
+    quality=int(os.environ.get('VISION_JPEG_QUALITY', 85))
+)
+# 変換前の音声を消すまでの猶予（秒）。負の値なら消さない
+AUDIO_DELETE_AFTER = int(os.environ.get('AUDIO_DELETE_AFTER', 600))
+# 保存する音声を低ビットレートのAACに変換する（PyAV がなければ拡張子の修正のみ）
+audio_compression_job = AudioCompressionJob(
+    metadata_manager,
+    media_store,
+    AudioTranscoder(bitrate=int(os.environ.get('AUDIO_BITRATE', 24000))),
+    delete_after=AUDIO_DELETE_AFTER if AUDIO_DELETE_AFTER >= 0 else None
+)
+
+def migrate_uploads(media=True, audio=True):
+    """既存の撮影のファイルを新しい配置へ移し、音声を変換する"""
+    if media:
+        migrated = migrate_flat_uploads(metadata_manager, media_store)
+        if migrated:
+            print(f"{migrated}件の撮影のファイルを移行しました")
+    if audio:
+        converted = audio_compression_job.migrate()
+        if converted:
+            print(f"{converted}件の音声を変換しました")
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """既存の撮影のファイルを移行し、音声を変換する（flask --app app migrate-uploads）"""
+    migrate_uploads()
+
+# アプリを読み込んだだけでアップロード済みのファイルを書き換えないよう、起動時の移行は
+# MEDIA_MIGRATE_ON_START=1 / AUDIO_MIGRATE_ON_START=1 を指定したときだけバックグラウンドで行う。
+# 音声の変換と同じスレッドで順に実行し、メタデータの書き換えが重ならないようにする
+MEDIA_MIGRATE_ON_START = os.environ.get('MEDIA_MIGRATE_ON_START', '0') == '1'
+AUDIO_MIGRATE_ON_START = os.environ.get('AUDIO_MIGRATE_ON_START', '0') == '1'
+if MEDIA_MIGRATE_ON_START or AUDIO_MIGRATE_ON_START:
+    audio_compression_job.executor.submit(migrate_uploads, MEDIA_MIGRATE_ON_START, AUDIO_MIGRATE_ON_START)
+
+app.jinja_env.globals['audio_mimetype'] = audio_mimetype
+app.jinja_env.globals['media_url'] = media_store.public_url
+
+def generate_thumbnails(image_path):
+    """サムネイルを生成する（失敗しても元画像で表示できるので処理は続ける）"""
+    try:
+        return thumbnail_generator.generate(image_path)
+    except Exception as e:
+        app.logger.warning(f"サムネイル生成エラー ({image_path}): {str(e)}")
+        return None
+
+def thumbnail_url(name):
+    """サムネイルの配信用URL（ストアに保存する前のサムネイルはアップロードフォルダからの相対パス）"""
+    if name.startswith('/'):
+        return media_store.public_url(name)
+    return url_for('thumbnail', filename=name)
+
+def build_srcset(thumbnails, fmt):
+    """サムネイル一覧から srcset 属性の値を作る"""
+    return ', '.join(
+        f"{thumbnail_url(t[fmt])} {t['width']}w"
+        for t in thumbnails if t.get(fmt)
+    )
 
 @app.route('/')
 def index():
@@ -33,197 +168,629 @@ def camera():
 
 @app.route('/album')
 def album():
-    # 画像ファイルとそれに対応するメタデータを取得
+    # メタデータから新しい順に1ページ分の画像を取得
+    limit = min(max(request.args.get('limit', 30, type=int), 1), 100)
+    cursor = request.args.get('cursor')
+    page, next_cursor = metadata_manager.get_album_page(limit=limit, cursor=cursor)
+
     images = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        if filename.startswith('image') and filename.endswith(('png', 'jpg', 'jpeg')):
-            # メタデータを取得
-            image_metadata = metadata_manager.get_image_data_by_filename(filename)
-            
-            # もしメタデータが存在すれば、画像データと一緒にリストに追加
-            if image_metadata:
-                # 画像のタイムスタンプを整形
-                timestamp = datetime.fromisoformat(image_metadata['timestamp']).strftime('%Y年%m月%d日 %H時%M分')
-                images.append({
-                    'filename': filename,
-                    'place_name': image_metadata['place_name'],
-                    'timestamp': timestamp
-                })
-
-    return render_template('album.html', images=images)
+    for image_id, image_metadata in page:
+        # サムネイルが未作成の古い画像は初回表示時に作成する
+        thumbnails = image_metadata.get('thumbnails')
+        if not thumbnails:
+            with media_store.local_file(image_metadata['image_path']) as image_path:
+                thumbnails = generate_thumbnails(image_path) if image_path else None
+            if thumbnails:
+                metadata_manager.update_image_data(image_id, dict(image_metadata, thumbnails=thumbnails))
+
+        # 画像のタイムスタンプを整形
+        timestamp = datetime.fromisoformat(image_metadata['timestamp']).strftime('%Y年%m月%d日 %H時%M分')
+        images.append({
+            'image_id': image_id,
+            'image_url': media_store.public_url(image_metadata['image_path']),
+            'place_name': image_metadata['place_name'],
+            'timestamp': timestamp,
+            'thumbnail': thumbnail_url(thumbnails[0]['jpeg']) if thumbnails else None,
+            'srcset_jpeg': build_srcset(thumbnails or [], 'jpeg'),
+            'srcset_webp': build_srcset(thumbnails or [], 'webp')
+        })
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
+    return render_template('album.html', images=images, next_cursor=next_cursor, limit=limit)
+
+@app.route('/thumbnails/<path:filename>')
+def thumbnail(filename):
+    # ファイル名に内容ハッシュを含むため、長期間キャッシュさせる
+    if not os.path.basename(filename).startswith('thumb_'):
+        abort(404)
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=MEDIA_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/media/<path:key>')
+def media(key):
+    """ストアに保存した画像・音声を配信する
+
+    キーは内容ハッシュなので同じURLの中身は変わらない。ハッシュを強い ETag にして
+    immutable で長期間キャッシュさせ、再生し直しても通信が発生しないようにする。
+    条件付きリクエスト（304）と Range リクエスト（206、音声のシーク）にも応答する。
+    """
+    digest = media_store.digest_from_key(key)
+    if digest is None:
+        abort(404)
+    if not media_store.backend.is_local:
+        return redirect(media_store.backend.url(key))
+
+    # 保存したときと同じ場所を読む（アプリのディレクトリではなく保存先の root が基準）
+    path = media_store.backend.path(key)
+    if not os.path.isfile(path):
+        abort(404)
+    if MEDIA_SENDFILE == 'x-accel':
+        # 本体は nginx が送る（Range にも nginx が応答する）
+        response = Response(mimetype=content_type(key))
+        response.headers['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX.rstrip('/') + '/' + key
+        response.set_etag(digest)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            del response.headers['X-Accel-Redirect']
+    else:
+        response = send_file(path, mimetype=content_type(key), etag=digest, max_age=MEDIA_MAX_AGE)
+        response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+RAW_IMAGE_MIMETYPES = ('image/jpeg', 'image/png', 'image/webp', 'application/octet-stream')
+
+def save_uploaded_image(image_path):
+    """リクエストの画像を image_path に保存し、(緯度, 経度) を返す
+
+    - multipart/form-data: image ファイルと latitude / longitude フォーム項目
+    - 画像のバイナリ本文: latitude / longitude はクエリパラメータ
+    - JSON (従来のクライアント): {'image': dataURL, 'latitude', 'longitude'}
+    """
+    if request.mimetype == 'multipart/form-data':
+        # 大きなファイルは Werkzeug が一時ファイルに退避するため、メモリ使用量は一定
+        upload = request.files['image']
+        with atomic_target(image_path) as tmp_path:
+            upload.save(tmp_path, buffer_size=UPLOAD_CHUNK_SIZE)
+        return float(request.form['latitude']), float(request.form['longitude'])
+
+    if request.mimetype in RAW_IMAGE_MIMETYPES:
+        # 本文をチャンク単位でそのままファイルに書き出す
+        with atomic_target(image_path) as tmp_path, open(tmp_path, 'wb') as f:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        return float(request.args['latitude']), float(request.args['longitude'])
+
+    data = request.get_json()
+    image_data = data['image']
+
+    # Base64データの処理
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+
+    import base64
+    atomic_write(image_path, base64.b64decode(image_data))
+    return data['latitude'], data['longitude']
+
+def request_flag(name):
+    """クエリ・フォーム・JSON のいずれかで指定された真偽値フラグを取得する"""
+    value = request.args.get(name) or request.form.get(name)
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def find_cached_analysis(image_path, latitude, longitude, fresh=False):
+    """近くで撮影された似た画像の分析結果を探し、(画像ハッシュ, 結果) を返す"""
+    start = time.perf_counter()
     try:
-        data = request.get_json()
-        image_data = data['image']
-        latitude = data['latitude']
-        longitude = data['longitude']
-
-        # Base64データの処理
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
+        query_hash = image_hash(image_path)
+    except OSError:
+        return None, None
+
+    if fresh or geo_cache.radius_m <= 0:
+        return query_hash, None
+
+    match = geo_cache.find(latitude, longitude, query_hash)
+    if not match:
+        return query_hash, None
+
+    cached_id, cached_data, distance = match
+    app.logger.info(f"分析結果を再利用します: {cached_id} ({distance:.1f}m)")
+    return query_hash, {
+        'description': cached_data['description'],
+        'place': cached_data['place_name'],
+        'audio_path': cached_data.get('audio_path'),
+        # 1つのファイルで保存した以前の撮影は、そのファイルを1文目として扱う
+        'audio_chunks': (
+            cached_data.get('audio_chunks')
+            or ([cached_data['audio_path']] if cached_data.get('audio_path') else [])
+        ),
+        'cached_from': cached_id,
+        'timings': {'cache': time.perf_counter() - start}
+    }
 
-        # 画像分析の実行
-        result = image_analyzer.analyze_image(image_data, latitude, longitude)
+@contextmanager
+def timed_stage(timings, stage):
+    """ブロックの所要時間(秒)を timings[stage] に記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+def job_image_path(job):
+    """ジョブの分析待ちの画像のパス（以前のジョブはアップロードフォルダ直下のファイル名を持つ）"""
+    if job.get('image_file'):
+        return job['image_file']
+    return os.path.join(app.config['UPLOAD_FOLDER'], job['image_filename'])
+
+def save_audio_chunk(content):
+    """説明文の1文分の音声を保存し、その参照を返す"""
+    return media_store.put_bytes(content, AUDIO_EXTENSION)
+
+def update_capture_audio(image_id, **fields):
+    """撮影の音声の情報（audio_chunks / audio_status）を更新する"""
+    image_data = metadata_manager.get_image_data(image_id)
+    if image_data:
+        metadata_manager.update_image_data(image_id, dict(image_data, **fields))
+
+def run_analysis(job, report):
+    """保存済みの画像を分析し、音声・サムネイル・メタデータを保存する（ジョブキューのワーカーで実行）"""
+    image_path = job_image_path(job)
+    latitude, longitude = job['latitude'], job['longitude']
+    # 画像・音声・メタデータで同じ撮影IDを使う（撮影IDを持たない以前のジョブはタイムスタンプ）
+    capture_id = job.get('capture_id') or job['timestamp']
+    image_id = None
+    start = time.perf_counter()
+    # 段階ごとの所要時間（分析・音声合成の内訳は ImageAnalyzer が記録する）
+    timings = {}
+    try:
+        # 近くで撮影された同じ被写体の分析結果があれば再利用する
+        report('checking_cache')
+        query_hash, result = find_cached_analysis(image_path, latitude, longitude, fresh=job.get('fresh', False))
+        image_bytes = None
+
+        speech = None
+        if result:
+            audio_url = result['audio_path']
+            audio_chunks = result['audio_chunks']
+        else:
+            # ビジョンモデル向けに縮小・再エンコード
+            with timed_stage(timings, 'decode'):
+                prepared = image_preprocessor.prepare_file(image_path)
+            app.logger.info(
+                f"画像を縮小しました: {prepared['bytes_before']} -> {prepared['bytes_after']} bytes "
+                f"({prepared['width']}x{prepared['height']})"
+            )
+            image_bytes = {
+                'before': prepared['bytes_before'],
+                'after': prepared['bytes_after']
+            }
 
-        # 画像の保存
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        image_filename = f"image_{timestamp}.jpg"
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-        
-        # Base64データを画像として保存
-        import base64
-        image_binary = base64.b64decode(image_data)
-        with open(image_path, 'wb') as f:
-            f.write(image_binary)
-
-        # 音声ファイルの保存
-        audio_filename = f"audio_{timestamp}.wav"
-        audio_path = os.path.join(app.config['UPLOAD_FOLDER'], audio_filename)
-        with open(audio_path, 'wb') as audio_file:
-            audio_file.write(result['audio_response'].content)
+            # 画像分析の実行（説明文の音声合成は文ごとに並行して進む）
+            report('analyzing')
+            result = image_analyzer.analyze_image(prepared['base64'], latitude, longitude)
+            speech = result['speech']
+            audio_url = None
+            audio_chunks = []
+
+        # アルバム用サムネイルの生成
+        report('saving')
+        with timed_stage(timings, 'thumbnails'):
+            thumbnails = generate_thumbnails(image_path)
+
+        # 分析待ちの画像をストアへ移す（同じ画像が保存済みならそれを使う）
+        with timed_stage(timings, 'image_write'):
+            image_url = media_store.put_file(image_path, 'jpg')
+
+        # 最初の文の音声ができたら撮影を保存し、残りの音声を待たずにチャット画面へ移れるようにする
+        chunk_results = speech.results() if speech else iter(())
+        if speech:
+            report('saving_audio')
+            with timed_stage(timings, 'tts_first'):
+                for _, content in chunk_results:
+                    audio_chunks.append(save_audio_chunk(content))
+                    break
 
         # メタデータの保存
-        image_id = metadata_manager.save_image_data({
-            'timestamp': datetime.now().isoformat(),
-            'image_path': f"/static/uploads/{image_filename}",
-            'audio_path': f"/static/uploads/{audio_filename}",
-            'description': result['description'],
-            'place_name': result['place'],
-            'latitude': latitude,
-            'longitude': longitude
-        })
-
-        return jsonify({
+        with timed_stage(timings, 'metadata'):
+            image_id = metadata_manager.save_image_data({
+                'timestamp': datetime.now().isoformat(),
+                'image_path': image_url,
+                'audio_path': audio_url,
+                'audio_chunks': audio_chunks,
+                'audio_status': 'pending' if speech else 'done',
+                'description': result['description'],
+                'place_name': result['place'],
+                'latitude': latitude,
+                'longitude': longitude,
+                'thumbnails': thumbnails,
+                'image_hash': query_hash,
+                'cached_from': result.get('cached_from')
+            }, image_id=capture_id)
+        timings['first_audio'] = time.perf_counter() - start
+        report('speaking', {'image_id': image_id})
+
+        if speech:
+            # 残りの文の音声は、できた順ではなく文の順に追加する
+            with timed_stage(timings, 'tts'):
+                for _, content in chunk_results:
+                    audio_chunks.append(save_audio_chunk(content))
+                    update_capture_audio(image_id, audio_chunks=list(audio_chunks))
+            update_capture_audio(image_id, audio_status='done')
+            for chunk_url in audio_chunks:
+                audio_compression_job.submit(chunk_url)
+
+        timings.update(result['timings'])
+        timings['total'] = time.perf_counter() - start
+
+        return {
             'success': True,
             'image_id': image_id,
             'description': result['description'],
             'place': result['place'],
-            'audio_file': f"/static/uploads/{audio_filename}",
-            'image_file': f"/static/uploads/{image_filename}"
+            'audio_file': audio_url,
+            'audio_chunks': audio_chunks,
+            'image_file': image_url,
+            'cached': 'cached_from' in result,
+            'timings': timings,
+            'image_bytes': image_bytes
+        }
+
+    except Exception:
+        import traceback
+        app.logger.error(f"Analysis error: {traceback.format_exc()}")
+        # 分析に失敗した画像は残さない
+        if image_id is None and os.path.exists(image_path):
+            os.remove(image_path)
+        elif image_id is not None:
+            # 保存済みの撮影は、途中までの音声で再生できるようにする
+            update_capture_audio(image_id, audio_status='failed')
+        raise
+
+# 分析は時間がかかるため、Webワーカーを占有しないようジョブキューで実行する
+analysis_queue = JobQueue(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'jobs.db'),
+    run_analysis,
+    max_workers=int(os.environ.get('ANALYSIS_WORKERS', 2))
+)
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    image_path = None
+    try:
+        # 画像の保存
+        # 同じ秒に複数の撮影があっても重ならないよう、撮影ごとに一意なIDを作る
+        capture_id = new_capture_id()
+        image_path = media_store.incoming_path(f"image_{capture_id}.jpg")
+        latitude, longitude = save_uploaded_image(image_path)
+        if os.path.getsize(image_path) == 0:
+            raise ValueError("画像が送信されていません")
+
+        # 分析をジョブとして登録し、すぐに応答する（結果は /jobs/<job_id> で確認）
+        job_id = analysis_queue.submit({
+            'image_file': image_path,
+            'capture_id': capture_id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'fresh': request_flag('fresh')
+        })
+        response = jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': url_for('job_status', job_id=job_id)
         })
+        response.status_code = 202
+        response.headers['Location'] = url_for('job_status', job_id=job_id)
+        return response
 
     except Exception as e:
         import traceback
         error_detail = traceback.format_exc()
         app.logger.error(f"Analysis error: {error_detail}")
+        # 登録できなかった画像は残さない
+        if image_path and os.path.exists(image_path):
+            os.remove(image_path)
         return jsonify({
             'success': False,
             'error': f"分析中にエラーが発生しました: {str(e)}"
         }), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = analysis_queue.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+
+    response_data = {
+        'success': job['status'] != 'failed',
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'progress': job['progress']
+    }
+    if job['status'] == 'done':
+        # 配信用のURL（署名付きURLなど）は問い合わせのたびに作る
+        response_data['result'] = dict(
+            job['result'],
+            audio_file=media_store.public_url(job['result']['audio_file']),
+            audio_chunks=[media_store.public_url(url) for url in job['result'].get('audio_chunks') or ()],
+            image_file=media_store.public_url(job['result']['image_file'])
+        )
+    elif job['status'] == 'running' and job['result']:
+        # 最初の音声ができて撮影が保存された（残りの音声はチャット画面で受け取る）
+        response_data['image_id'] = job['result']['image_id']
+    elif job['status'] == 'failed':
+        response_data['error'] = f"分析中にエラーが発生しました: {job['error']}"
+
+    response = jsonify(response_data)
+    response.headers['Cache-Control'] = 'no-store'
+    if job['status'] in ('queued', 'running'):
+        # 次に問い合わせるまでの目安（秒）
+        response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # 実行が始まる前のジョブだけ取り消せる
+    if not analysis_queue.cancel(job_id):
+        return jsonify({'success': False})
+
+    # 取り消した撮影の画像は残さない
+    job = analysis_queue.get(job_id)
+    image_path = job_image_path(job['payload'])
+    if os.path.exists(image_path):
+        os.remove(image_path)
+    return jsonify({'success': True})
+
 @app.route('/chat/<image_id>')
 def chat(image_id):
     # メタデータから画像情報を取得
     image_data = metadata_manager.get_image_data(image_id)
     if not image_data:
         return redirect(url_for('index'))
-    
-    # チャットのコンテキストをセッションに保存
-    session['chat_context'] = {
-        'image_id': image_id,
-        'place_name': image_data['place_name'],
-        'description': image_data['description'],
-        'latitude': image_data['latitude'],
-        'longitude': image_data['longitude']
-    }
-    
-    # チャット履歴の初期化（初回説明を含める）
-    session['chat_history'] = [{
-        "type": "assistant",
-        "content": image_data['description'],
-        "timestamp": datetime.now().isoformat()
-    }]
-    
+
+    # 同じ画像の会話が続いていればそれを使い、なければ初回説明を含めて新しく作る
+    chat_id = session.get('chat_id')
+    context = chat_store.get_context(chat_id)
+    if not context or context['image_id'] != image_id:
+        chat_id = chat_store.create(
+            {
+                'image_id': image_id,
+                'place_name': image_data['place_name'],
+                'description': image_data['description'],
+                'latitude': image_data['latitude'],
+                'longitude': image_data['longitude']
+            },
+            [{
+                "type": "assistant",
+                "content": image_data['description'],
+                "timestamp": datetime.now().isoformat()
+            }]
+        )
+        # セッションのクッキーには会話IDだけを保存する
+        session['chat_id'] = chat_id
+
     return render_template('chat.html', 
                          image_data=image_data,
-                         chat_history=session['chat_history'])
+                         description_audio=description_audio(image_id, image_data),
+                         chat_history=chat_store.get_history(chat_id))
+
+def description_audio(image_id, image_data):
+    """文ごとに保存した説明の音声の配信用URLと合成の状態（1つのファイルの撮影は None）"""
+    if 'audio_status' not in image_data:
+        return None
+    chunks = image_data.get('audio_chunks') or ()
+    if not chunks and image_data['audio_status'] == 'done' and image_data.get('audio_path'):
+        chunks = [image_data['audio_path']]
+    return {
+        'chunks': [media_store.public_url(url) for url in chunks],
+        'status': image_data['audio_status'],
+        'status_url': url_for('description_audio_status', image_id=image_id)
+    }
 
-@app.route('/chat/message', methods=['POST'])
-def chat_message():
-    try:
-        data = request.get_json()
-        message = data['message']
-        with_audio = data.get('with_audio', False)
-        context = session.get('chat_context')
-        chat_history = session.get('chat_history', [])
-
-        if not context:
-            raise Exception("チャットセッションが見つかりません")
-
-        # ユーザーメッセージを履歴に追加
-        chat_history.append({
-            "type": "user",
-            "content": message,
-            "timestamp": datetime.now().isoformat()
+@app.route('/chat/<image_id>/audio')
+def description_audio_status(image_id):
+    """説明の音声の合成状況（合成中はチャット画面が問い合わせ、できた文から続けて再生する）"""
+    image_data = metadata_manager.get_image_data(image_id)
+    if not image_data:
+        return jsonify({'success': False, 'error': '画像が見つかりません'}), 404
+    audio = description_audio(image_id, image_data) or {
+        'chunks': [media_store.public_url(image_data['audio_path'])] if image_data.get('audio_path') else [],
+        'status': 'done',
+        'status_url': url_for('description_audio_status', image_id=image_id)
+    }
+    response = jsonify(dict(audio, success=True))
+    response.headers['Cache-Control'] = 'no-store'
+    if audio['status'] == 'pending':
+        response.headers['Retry-After'] = '1'
+    return response
+
+def build_chat_messages(context, chat_history, chat_id=None):
+    """チャットのコンテキストと履歴から GPT へ送るメッセージを組み立てる（トークン数の上限内に収める）"""
+    system_messages = guide_chat_messages(context['place_name'], context['description'])
+
+    # チャット履歴の追加
+    history = []
+    for msg in chat_history:
+        role = "assistant" if msg["type"] == "assistant" else "user"
+        history.append({
+            "role": role,
+            "content": msg["content"]
         })
+    return chat_context_manager.build(system_messages, history, key=chat_id)
 
-        # GPTへの問い合わせ
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    f"あなたは{context['place_name']}の観光ガイドです。"
-                    f"以下の説明に基づいて回答してください：\n{context['description']}"
-                )
-            }
-        ]
+def generate_chat_audio(text):
+    """チャットの応答を音声ファイルにし、そのURLを返す"""
+    audio_response = speech_pipeline.synthesize(text)
 
-        # チャット履歴の追加
-        for msg in chat_history:
-            role = "assistant" if msg["type"] == "assistant" else "user"
-            messages.append({
-                "role": role,
-                "content": msg["content"]
-            })
-
-        # レスポンス生成
-        response = openai_client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=messages,
-            max_tokens=500
-        )
+    return media_store.public_url(media_store.put_bytes(audio_response.content, AUDIO_EXTENSION))
+
+# --- チャットの応答（Flask のルートと asgi.py の非同期のルートで共有する） ---
 
-        response_text = response.choices[0].message.content
+CHAT_SESSION_NOT_FOUND = "チャットセッションが見つかりません"
+
+def begin_chat_turn(chat_id, message):
+    """ユーザーメッセージを履歴に追加し、GPT へ送るメッセージを返す（会話が見つからなければ None）"""
+    context = chat_store.get_context(chat_id)
+    if not context:
+        return None
+
+    chat_store.append(chat_id, {
+        "type": "user",
+        "content": message,
+        "timestamp": datetime.now().isoformat()
+    })
+    return build_chat_messages(context, chat_store.get_history(chat_id), chat_id)
 
-        # アシスタントの応答を履歴に追加
-        chat_history.append({
+def finish_chat_turn(chat_id, response, with_audio):
+    """アシスタントの応答を履歴に追加し、/chat/message の結果を返す"""
+    usage_tracker.record('chat', response)
+    response_text = response.choices[0].message.content
+
+    chat_store.append(chat_id, {
+        "type": "assistant",
+        "content": response_text,
+        "timestamp": datetime.now().isoformat()
+    })
+
+    result = {
+        'success': True,
+        'message': response_text
+    }
+    # 音声の生成（オプション）
+    if with_audio:
+        result['audio_file'] = generate_chat_audio(response_text)
+    return result
+
+def chat_error(error):
+    """チャットのルートのエラーを (結果, ステータスコード, ヘッダー) にする"""
+    body = {'success': False, 'error': str(error)}
+    if isinstance(error, ProviderBusyError):
+        return body, 503, busy_response_headers(error)
+    return body, 500, {}
+
+def busy_response_headers(error):
+    """混み合って断ったときに、やり直すまでの秒数をクライアントに伝える"""
+    return {'Retry-After': str(error.retry_after)}
+
+def sse_event(event, data):
+    """Server-Sent Events 形式の1イベントを作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def save_chat_audio_chunk(content):
+    """ストリーミング応答の1文分の音声を保存し、そのURLを返す"""
+    return media_store.public_url(media_store.put_bytes(content, AUDIO_EXTENSION))
+
+class ChatReplyStream:
+    """ストリーミング応答のチャンクを SSE のイベントにし、生成し終えたら履歴に保存する
+
+    on_chunk はブロックしない（音声合成はスレッドプールで始めるだけ）。
+    audio_events と finish はファイルの保存や音声合成の完了待ちでブロックするため、
+    非同期のルートではスレッドプールで呼ぶ。
+    """
+
+    def __init__(self, chat_id, with_audio):
+        self.chat_id = chat_id
+        # 文が完成するたびに音声合成を始め、できた順ではなく文の順にクライアントへ送る
+        self.speech_queue = speech_pipeline.stream() if with_audio else None
+        self.parts = []
+
+    def on_chunk(self, chunk):
+        """1チャンク分の token イベントのリストを返す"""
+        if not chunk.choices:
+            # 最後のチャンクにはトークン数だけが入っている
+            usage_tracker.record('chat.stream', chunk)
+            return []
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return []
+        self.parts.append(delta)
+        if self.speech_queue:
+            self.speech_queue.feed(delta)
+        return [sse_event('token', {'content': delta})]
+
+    def audio_ready(self):
+        """送れる音声があるか"""
+        return bool(self.speech_queue and self.speech_queue.pending and self.speech_queue.pending[0].done())
+
+    def audio_events(self, wait=False):
+        """合成済みの音声を保存し、audio_chunk イベントのリストを返す"""
+        if not self.speech_queue:
+            return []
+        return [
+            sse_event('audio_chunk', {'index': index, 'audio_file': save_chat_audio_chunk(content)})
+            for index, content in self.speech_queue.ready(wait=wait)
+        ]
+
+    def finish(self):
+        """応答を履歴に保存し、残りの音声と done イベントのリストを返す"""
+        reply = {
             "type": "assistant",
-            "content": response_text,
+            "content": ''.join(self.parts),
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        # 履歴はサーバー側にあるので、生成し終えた時点でそのまま保存できる
+        chat_store.append(self.chat_id, reply)
+        events = []
+        if self.speech_queue:
+            self.speech_queue.close()
+            events = self.audio_events(wait=True)
+        events.append(sse_event('done', {'message': reply}))
+        return events
 
-        # セッションに履歴を保存
-        session['chat_history'] = chat_history
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
 
-        result = {
-            'success': True,
-            'message': response_text,
-            'history': chat_history
-        }
+@app.route('/chat/message', methods=['POST'])
+def chat_message():
+    try:
+        data = request.get_json()
+        chat_id = session.get('chat_id')
+        messages = begin_chat_turn(chat_id, data['message'])
+        if messages is None:
+            raise Exception(CHAT_SESSION_NOT_FOUND)
+
+        response = provider.chat('chat', messages, max_tokens=500)
+        return jsonify(finish_chat_turn(chat_id, response, data.get('with_audio', False)))
 
-        # 音声の生成（オプション）
-        if with_audio:
-            audio_response = openai_client.audio.speech.create(
-                model="tts-1",
-                voice="nova",
-                input=response_text
+    except Exception as e:
+        body, status, headers = chat_error(e)
+        return jsonify(body), status, headers
+
+@app.route('/chat/message/stream', methods=['POST'])
+def chat_message_stream():
+    data = request.get_json()
+    chat_id = session.get('chat_id')
+    messages = begin_chat_turn(chat_id, data['message'])
+    if messages is None:
+        return jsonify({'success': False, 'error': CHAT_SESSION_NOT_FOUND}), 500
+
+    def generate():
+        try:
+            stream = provider.chat(
+                'chat',
+                messages,
+                max_tokens=500,
+                stream=True,
+                extra_body=STREAM_USAGE_OPTIONS
             )
-            
-            audio_filename = f"chat_audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav"
-            audio_path = os.path.join(app.config['UPLOAD_FOLDER'], audio_filename)
-            audio_response.stream_to_file(audio_path)
-            
-            result['audio_file'] = f"/static/uploads/{audio_filename}"
+            reply = ChatReplyStream(chat_id, data.get('with_audio', False))
+            for chunk in stream:
+                yield from reply.on_chunk(chunk)
+                yield from reply.audio_events()
+            yield from reply.finish()
 
-        return jsonify(result)
+        except Exception as e:
+            app.logger.error(f"Chat stream error: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
 
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 @app.route('/launch_gui_chat/<image_id>')
 def launch_gui_chat_route(image_id):
@@ -233,12 +800,32 @@ def launch_gui_chat_route(image_id):
 
     # GUIチャットの起動
     launch_gui_chat(
-        openai_client,
+        provider,
         image_data['place_name'],
         image_data['description']
     )
 
     return jsonify({'success': True, 'message': 'GUIチャットを起動しました'})
 
+@app.route('/stats/tts_cache')
+def tts_cache_stats():
+    return jsonify(tts_cache.stats())
+
+@app.route('/stats/chat_context')
+def chat_context_stats():
+    return jsonify(chat_context_manager.stats())
+
+@app.route('/stats/media')
+def media_stats():
+    return jsonify(media_store.stats())
+
+@app.route('/stats/openai')
+def openai_stats():
+    return jsonify(provider.policy.stats())
+
+@app.route('/stats/prompt_cache')
+def prompt_cache_stats():
+    return jsonify(usage_tracker.stats())
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
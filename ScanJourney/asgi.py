@@ -0,0 +1,95 @@
+# ASGI で起動するためのエントリーポイント
+#
+#   uvicorn asgi:app --workers 2
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+#
+# OpenAI の応答を待つチャットのルートだけを非同期で処理し、1プロセスで多数のリクエストを同時に待てるようにする。
+# それ以外のルート（画面・アルバム・/analyze など）は従来の Flask アプリにそのまま渡す。
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    app as flask_app,
+    provider,
+    begin_chat_turn,
+    finish_chat_turn,
+    chat_error,
+    sse_event,
+    ChatReplyStream,
+    CHAT_SESSION_NOT_FOUND,
+    SSE_HEADERS
+)
+from utils.prompts import STREAM_USAGE_OPTIONS
+
+def session_chat_id(request):
+    """Flask のセッションクッキーから会話IDを取り出す（Flask 側のルートと同じ会話を使う）"""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        session_data = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    return session_data.get('chat_id')
+
+async def chat_message(request):
+    chat_id = session_chat_id(request)
+    try:
+        data = await request.json()
+        # 会話の読み書き（SQLite）・トークン数の計算・音声合成はブロックするため、スレッドプールで実行する
+        messages = await run_in_threadpool(begin_chat_turn, chat_id, data['message'])
+        if messages is None:
+            raise Exception(CHAT_SESSION_NOT_FOUND)
+
+        # GPTへの問い合わせ（応答を待つ間もイベントループは他のリクエストを処理する）
+        response = await provider.achat('chat', messages, max_tokens=500)
+        result = await run_in_threadpool(finish_chat_turn, chat_id, response, data.get('with_audio', False))
+        return JSONResponse(result)
+
+    except Exception as e:
+        body, status, headers = chat_error(e)
+        return JSONResponse(body, status_code=status, headers=headers)
+
+async def chat_message_stream(request):
+    chat_id = session_chat_id(request)
+    data = await request.json()
+    messages = await run_in_threadpool(begin_chat_turn, chat_id, data['message'])
+    if messages is None:
+        return JSONResponse({'success': False, 'error': CHAT_SESSION_NOT_FOUND}, status_code=500)
+
+    async def generate():
+        try:
+            stream = await provider.achat(
+                'chat',
+                messages,
+                max_tokens=500,
+                stream=True,
+                extra_body=STREAM_USAGE_OPTIONS
+            )
+            reply = ChatReplyStream(chat_id, data.get('with_audio', False))
+            async for chunk in stream:
+                for event in reply.on_chunk(chunk):
+                    yield event
+                # 音声の保存はスレッドプールで行う（合成済みの音声があるときだけ）
+                if reply.audio_ready():
+                    for event in await run_in_threadpool(reply.audio_events):
+                        yield event
+            # 履歴の保存と残りの音声合成の完了待ち
+            for event in await run_in_threadpool(reply.finish):
+                yield event
+
+        except Exception as e:
+            flask_app.logger.error(f"Chat stream error: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+app = Starlette(routes=[
+    Route('/chat/message', chat_message, methods=['POST']),
+    Route('/chat/message/stream', chat_message_stream, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(flask_app))
+])
@@ -0,0 +1,360 @@
+# ScanJourney の負荷試験・性能計測
+#
+#   python benchmark.py --users 8 --duration 60 --output bench.json
+#   python benchmark.py --url http://localhost:5000 --users 8 --iterations 5
+#   python benchmark.py --compare before.json after.json
+#
+# --url を指定しなければ、一時ディレクトリでアプリを起動し、OpenAI の代わりに FakeClient を使う
+# （待ち時間は FAKE_LLM_LATENCY / FAKE_TOKEN_LATENCY / FAKE_TTS_LATENCY / FAKE_LATENCY_JITTER で変更）。
+# 仮想ユーザーは「撮影の分析 → 結果の待機 → チャット → アルバム表示」を繰り返し、
+# ルートごと・分析の段階ごとの p50/p95/p99 とスループットを JSON に出力する。
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils.job_queue import FINISHED_STATUSES
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_UPLOADS = os.path.join(BASE_DIR, 'static', 'uploads')
+
+CHAT_QUESTIONS = [
+    "ここの歴史をもう少し詳しく教えてください。",
+    "近くにおすすめの食べ物はありますか？",
+    "写真を撮るならどこがいいですか？"
+]
+
+def percentile(values, p):
+    """values の p パーセンタイル（線形補間）"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+def summarize(samples, errors, duration):
+    """所要時間(秒)のリストから集計値（ミリ秒）を作る"""
+    summary = {
+        'count': len(samples),
+        'errors': errors,
+        'throughput': len(samples) / duration if duration else 0.0
+    }
+    for p in (50, 95, 99):
+        value = percentile(samples, p)
+        summary[f"p{p}"] = round(value * 1000, 2) if value is not None else None
+    summary['mean'] = round(sum(samples) / len(samples) * 1000, 2) if samples else None
+    summary['max'] = round(max(samples) * 1000, 2) if samples else None
+    return summary
+
+class Recorder:
+    """仮想ユーザーが計測した所要時間を集める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.stages = {}
+        self.errors = {}
+
+    def route(self, name, seconds, ok=True):
+        with self._lock:
+            self.routes.setdefault(name, [])
+            self.errors.setdefault(name, 0)
+            if ok:
+                self.routes[name].append(seconds)
+            else:
+                self.errors[name] += 1
+
+    def stage_timings(self, timings):
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.stages.setdefault(stage, []).append(seconds)
+
+    def report(self, duration):
+        with self._lock:
+            return {
+                'routes': {
+                    name: summarize(samples, self.errors.get(name, 0), duration)
+                    for name, samples in sorted(self.routes.items())
+                },
+                'stages': {
+                    name: summarize(samples, 0, duration)
+                    for name, samples in sorted(self.stages.items())
+                }
+            }
+
+def open_metadata(uploads_dir):
+    """uploads_dir のメタデータを、アプリと同じ保存先（metadata.db があれば SQLite）から開く"""
+    from utils.metadata_manager import MetadataManager
+    from utils.sqlite_metadata_store import SqliteMetadataStore
+    metadata_file = os.path.join(uploads_dir, 'metadata.json')
+    db_file = os.path.join(uploads_dir, 'metadata.db')
+    if os.path.exists(db_file):
+        return MetadataManager(metadata_file, store=SqliteMetadataStore(db_file, json_file=metadata_file))
+    if os.path.exists(metadata_file):
+        return MetadataManager(metadata_file)
+    return None
+
+def load_captures(uploads_dir=SAMPLE_UPLOADS):
+    """過去の撮影（画像と緯度・経度）を読み込む。なければ合成した画像を使う
+
+    画像はメディアストアに移行済みでも以前のフラットな配置でも読めるよう、MediaStore を通して読む。
+    """
+    from utils.media_store import MediaStore
+    from utils.media_backends import create_media_backend
+
+    captures = []
+    metadata_manager = open_metadata(uploads_dir)
+    if metadata_manager is not None:
+        media_store = MediaStore(uploads_dir, backend=create_media_backend(os.path.join(uploads_dir, 'media'), '/media'))
+        for _, data in metadata_manager.get_images_by_timestamp():
+            with media_store.local_file(data.get('image_path')) as image_file:
+                if image_file:
+                    with open(image_file, 'rb') as f:
+                        captures.append((f.read(), data['latitude'], data['longitude']))
+    if captures:
+        return captures
+
+    logging.warning(
+        f"{uploads_dir} から撮影を読み込めませんでした。実際の撮影ではなく、合成した画像で計測します"
+    )
+    from PIL import Image
+    for i in range(4):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1600, 1200), (60 * i, 120, 200 - 40 * i)).save(buffer, 'JPEG', quality=90)
+        captures.append((buffer.getvalue(), 35.0 + i * 0.01, 135.0 + i * 0.01))
+    return captures
+
+class TestClientSession:
+    """同じプロセスで起動した Flask アプリに、テストクライアントでリクエストする"""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        response = self.client.open(path, method=method, data=data, json=json_body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+class HttpSession:
+    """起動中のサーバーに HTTP でリクエストする（クッキーはユーザーごとに保持）"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        response = self.session.request(method, self.base_url + path, data=data, json=json_body,
+                                        headers=headers, timeout=300)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body
+
+def timed_request(recorder, name, session, method, path, **kwargs):
+    """リクエストを送り、所要時間をルート名ごとに記録する"""
+    start = time.perf_counter()
+    try:
+        status, body = session.request(method, path, **kwargs)
+    except Exception as e:
+        recorder.route(name, time.perf_counter() - start, ok=False)
+        raise RuntimeError(f"{name}: {str(e)}")
+    ok = status < 400 and not (isinstance(body, dict) and body.get('success') is False)
+    recorder.route(name, time.perf_counter() - start, ok=ok)
+    if not ok:
+        raise RuntimeError(f"{name}: HTTP {status} {body}")
+    return body
+
+def run_user(session, recorder, captures, args, deadline, seed):
+    """1人の仮想ユーザーのシナリオを繰り返す"""
+    rng = random.Random(seed)
+    iteration = 0
+    while (args.iterations and iteration < args.iterations) or (not args.iterations and time.time() < deadline):
+        iteration += 1
+        image, latitude, longitude = rng.choice(captures)
+        try:
+            # 撮影の分析（登録 → 完了まで待機）
+            start = time.perf_counter()
+            query = f"latitude={latitude}&longitude={longitude}" + ('&fresh=1' if args.fresh else '')
+            job = timed_request(recorder, 'POST /analyze', session, 'POST', f"/analyze?{query}",
+                                data=image, headers={'Content-Type': 'image/jpeg'})
+            while True:
+                time.sleep(args.poll_interval)
+                status = timed_request(recorder, 'GET /jobs/<id>', session, 'GET', job['status_url'])
+                if status['status'] in FINISHED_STATUSES:
+                    break
+            ok = status['status'] == 'done'
+            recorder.route('analysis (end to end)', time.perf_counter() - start, ok=ok)
+            if not ok:
+                logging.warning(f"analysis {status['status']}: {status.get('error', '')}")
+                continue
+            result = status['result']
+            recorder.stage_timings(result.get('timings') or {})
+
+            # チャット
+            timed_request(recorder, 'GET /chat/<id>', session, 'GET', f"/chat/{result['image_id']}")
+            for _ in range(args.chat_turns):
+                timed_request(recorder, 'POST /chat/message', session, 'POST', '/chat/message',
+                              json_body={'message': rng.choice(CHAT_QUESTIONS), 'with_audio': args.with_audio})
+
+            # アルバム
+            timed_request(recorder, 'GET /album', session, 'GET', '/album')
+        except RuntimeError as e:
+            logging.warning(str(e))
+
+def start_local_app():
+    """一時ディレクトリを作業ディレクトリにしてアプリを読み込む（既存のアップロードは変更しない）"""
+    workdir = tempfile.mkdtemp(prefix='scanjourney-bench-')
+    os.makedirs(os.path.join(workdir, 'static', 'uploads'))
+    os.chdir(workdir)
+    os.environ.setdefault('LLM_PROVIDER', 'fake')
+    sys.path.insert(0, BASE_DIR)
+    from app import app as flask_app
+    flask_app.logger.setLevel(logging.WARNING)
+    return flask_app, workdir
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run_benchmark(args):
+    captures = load_captures(args.captures)
+    if args.url:
+        def new_session():
+            return HttpSession(args.url)
+        mode = 'http'
+    else:
+        flask_app, workdir = start_local_app()
+        print(f"作業ディレクトリ: {workdir}")
+
+        def new_session():
+            return TestClientSession(flask_app)
+        mode = 'local'
+
+    recorder = Recorder()
+    start = time.time()
+    deadline = start + args.duration
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        futures = [
+            executor.submit(run_user, new_session(), recorder, captures, args, deadline, args.seed + i)
+            for i in range(args.users)
+        ]
+        for future in futures:
+            future.result()
+    duration = time.time() - start
+
+    fake_env = {
+        name: os.environ[name] for name in (
+            'LLM_PROVIDER', 'FAKE_LLM_LATENCY', 'FAKE_TOKEN_LATENCY', 'FAKE_TTS_LATENCY',
+            'FAKE_LATENCY_JITTER', 'ANALYSIS_WORKERS', 'ANALYSIS_MODE'
+        ) if name in os.environ
+    }
+    result = {
+        'meta': {
+            'started_at': datetime.fromtimestamp(start).isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'mode': mode,
+            'url': args.url,
+            'users': args.users,
+            'duration_limit': None if args.iterations else args.duration,
+            'iterations': args.iterations,
+            'chat_turns': args.chat_turns,
+            'with_audio': args.with_audio,
+            'fresh': args.fresh,
+            'captures': len(captures),
+            'env': fake_env
+        },
+        'duration': round(duration, 3)
+    }
+    result.update(recorder.report(duration))
+    return result
+
+def print_report(result):
+    print(f"所要時間 {result['duration']}s / 仮想ユーザー {result['meta']['users']}人")
+    for section in ('routes', 'stages'):
+        print(f"\n[{section}] (ms)")
+        print(f"{'name':<24}{'count':>7}{'errors':>7}{'rps':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, s in result[section].items():
+            print(f"{name:<24}{s['count']:>7}{s['errors']:>7}{s['throughput']:>8.2f}"
+                  f"{s['p50'] or 0:>10.1f}{s['p95'] or 0:>10.1f}{s['p99'] or 0:>10.1f}")
+
+def compare(baseline, current, threshold, min_delta_ms):
+    """2つの結果の p95 を比べ、悪化したものの一覧を返す"""
+    regressions = []
+    for section in ('routes', 'stages'):
+        print(f"\n[{section}] p95 (ms)")
+        for name in sorted(set(baseline.get(section, {})) | set(current.get(section, {}))):
+            before = baseline.get(section, {}).get(name, {}).get('p95')
+            after = current.get(section, {}).get(name, {}).get('p95')
+            if before is None or after is None:
+                print(f"  {name:<24}{before!s:>10} -> {after!s:>10}")
+                continue
+            change = (after - before) / before if before else 0.0
+            regressed = after - before > min_delta_ms and change > threshold
+            mark = '  <- 悪化' if regressed else ''
+            print(f"  {name:<24}{before:>10.1f} -> {after:>10.1f} ({change:+.0%}){mark}")
+            if regressed:
+                regressions.append(f"{section}/{name}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='ScanJourney の負荷試験・性能計測')
+    parser.add_argument('--url', help='計測するサーバーのURL（省略時は同じプロセスで起動し FakeClient を使う）')
+    parser.add_argument('--users', type=int, default=4, help='同時に動かす仮想ユーザーの数')
+    parser.add_argument('--duration', type=float, default=30, help='計測時間（秒）')
+    parser.add_argument('--iterations', type=int, default=0, help='1ユーザーあたりの繰り返し回数（指定時は --duration を無視）')
+    parser.add_argument('--chat-turns', type=int, default=2, help='1回の撮影あたりのチャットの質問数')
+    parser.add_argument('--with-audio', action='store_true', help='チャットの応答を音声合成する')
+    parser.add_argument('--fresh', action='store_true', help='近くの撮影の分析結果を再利用しない')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='ジョブの状態を確認する間隔（秒）')
+    parser.add_argument('--captures', default=SAMPLE_UPLOADS, help='再生する撮影のディレクトリ（アプリのアップロードフォルダ）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果を保存する JSON ファイル')
+    parser.add_argument('--compare', nargs='+', metavar='JSON',
+                        help='結果を比較する（ファイル1つなら今回の計測と、2つならファイル同士）')
+    parser.add_argument('--threshold', type=float, default=0.2, help='悪化とみなす p95 の増加率')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0, help='悪化とみなす p95 の最小の増加量（ミリ秒）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.compare[1], 'r', encoding='utf-8') as f:
+            current = json.load(f)
+    else:
+        current = run_benchmark(args)
+        print_report(current)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(current, f, ensure_ascii=False, indent=2)
+            print(f"\n結果を保存しました: {args.output}")
+        if not args.compare:
+            return
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    regressions = compare(baseline, current, args.threshold, args.min_delta_ms)
+    if regressions:
+        print(f"\n悪化しています: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 from flask import Flask, render_template, request, jsonify, session, url_for
 import os
-from openai import OpenAI
 import base64
 from datetime import datetime
 from PIL import Image
 import io
 import json
+from utils.providers import create_provider
+from utils.speech_pipeline import SynthesizedAudio
+from utils.capture_ids import new_capture_id, atomic_write
+from utils.prompts import analysis_messages, DESCRIPTION_INSTRUCTIONS, PLACE_INSTRUCTIONS
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key')  # 必ず環境変数で設定
@@ -14,53 +17,18 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
 class ImageAnalyzer:
     def __init__(self, openai_api_key):
-        self.client = OpenAI(api_key=openai_api_key)
+        self.provider = create_provider(api_key=openai_api_key)
 
     def analyze_image(self, image_data, latitude, longitude):
         try:
-            messages = [
-                  {
-                      "role": "user",
-                      "content": [
-                          {
-                              "type": "text",
-                              "text": f"この画像は緯度{latitude}、経度{longitude}で撮影されました。"
-                                      f"画像の内容と撮影された場所について、名称を交えて詳しく説明してください。緯度と経度は説明に含めないでください。"
-                                      f"歴史的背景や周辺の観光スポット、危険な場所、治安、注意点についても具体的に触れてください。"
-                                      f"説明は日本語で、ガイドが観光客に説明するような親しみやすい口調でお願いします。"
-                          },
-                          {
-                              "type": "image_url",
-                              "image_url": {
-                                  "url": f"data:image/jpeg;base64,{image_data}"
-                              }
-                          }
-                      ]
-                  }
-              ]
-            
-            messages2 = [
-                  {
-                      "role": "user",
-                      "content": [
-                          {
-                              "type": "text",
-                              "text": f"緯度{latitude}、経度{longitude}で撮影されたこの場所の名前を、単語のみの形で答えてください。"
-                          },
-                          {
-                              "type": "image_url",
-                              "image_url": {
-                                  "url": f"data:image/jpeg;base64,{image_data}"
-                              }
-                          }
-                      ]
-                  }
-              ]
+            # 共通の指示 → 画像 → 撮影地点 の順にして、プロンプトキャッシュを効かせる
+            messages = analysis_messages(DESCRIPTION_INSTRUCTIONS, image_data, latitude, longitude)
+            messages2 = analysis_messages(PLACE_INSTRUCTIONS, image_data, latitude, longitude)
 
             # 画像分析の実行
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
+            response = self.provider.chat(
+                'description',
+                messages,
                 max_tokens=500
             )
             # response = self.client.chat.completions.create(
@@ -68,20 +36,16 @@ class ImageAnalyzer:
             #     messages=messages
             # )
 
-            response2 = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages2,
+            response2 = self.provider.chat(
+                'place',
+                messages2,
                 max_tokens=100
             )
 
             description = response.choices[0].message.content
             place = response2.choices[0].message.content
 
-            audio_response = self.client.audio.speech.create(
-                model="tts-1",
-                voice="nova",
-                input=response.choices[0].message.content
-            )
+            audio_response = SynthesizedAudio([self.provider.speech(description)])
 
             return description, place, audio_response
         except Exception as e:
@@ -98,13 +62,12 @@ class ImageManager:
     def save_image(self, image_data, latitude, longitude, description, place):
         try:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            image_filename = f"image_{timestamp}.jpg"
+            image_filename = f"image_{new_capture_id()}.jpg"
             image_path = os.path.join(self.upload_folder, image_filename)
 
             # Base64データをデコードして画像を保存
             image_binary = base64.b64decode(image_data.split(',')[1])
-            with open(image_path, 'wb') as f:
-                f.write(image_binary)
+            atomic_write(image_path, image_binary)
 
             # メタデータを保存
             self.metadata[image_filename] = {
@@ -146,7 +109,7 @@ def analyze():
         )
 
         # 音声ファイルの保存
-        audio_filename = f"audio_{image_filename.replace('.jpg', '.wav')}"
+        audio_filename = f"audio_{image_filename.replace('.jpg', '.mp3')}"
         audio_path = os.path.join(app.config['UPLOAD_FOLDER'], audio_filename)
         audio_response.stream_to_file(audio_path)
 
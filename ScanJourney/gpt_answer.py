@@ -1,34 +1,28 @@
 import os
-from openai import OpenAI
 from datetime import datetime
-import base64
-from PIL import Image
-import io
-from gtts import gTTS
+from utils.image_preprocessor import ImagePreprocessor
+from utils.tts_cache import TTSCache
+from utils.context_manager import ContextManager, provider_summarizer, strip_images
+from utils.providers import create_provider
+from utils.prompts import GUIDE_SYSTEM_PROMPT, usage_tracker
 
 class ChatGPTAssistant:
     def __init__(self, openai_api_key):
-        """OpenAI APIクライアントの初期化"""
-        self.client = OpenAI(api_key=openai_api_key)
+        """LLM・音声合成のプロバイダーの初期化"""
+        self.provider = create_provider(
+            api_key=openai_api_key,
+            tts_cache=TTSCache(os.path.join("audio_output", ".tts_cache"))
+        )
+        self.image_preprocessor = ImagePreprocessor()
+        # 長い会話でも送るトークン数を一定に保つ（古いやり取りは要約、過去の画像は送らない）
+        self.context_manager = ContextManager(summarizer=provider_summarizer(self.provider))
         self.conversation_history = []
         
     def encode_image_to_base64(self, image_path):
         """画像をbase64エンコードする"""
         try:
-            with Image.open(image_path) as img:
-                # 画像サイズが大きい場合はリサイズ
-                max_size = 2048
-                if max(img.size) > max_size:
-                    ratio = max_size / max(img.size)
-                    new_size = tuple(int(dim * ratio) for dim in img.size)
-                    img = img.resize(new_size, Image.Resampling.LANCZOS)
-
-                # 画像をJPEGフォーマットでバイト列に変換
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='JPEG')
-                img_byte_arr = img_byte_arr.getvalue()
-
-                return base64.b64encode(img_byte_arr).decode('utf-8')
+            # Webアプリと同じ前処理（回転補正・縮小・再エンコード）を使う
+            return self.image_preprocessor.prepare_file(image_path)['base64']
         except Exception as e:
             print(f"画像の処理中にエラーが発生しました: {str(e)}")
             return None
@@ -36,7 +30,6 @@ class ChatGPTAssistant:
     def process_chat(self, user_input):
         """チャットメッセージを処理する"""
         try:
-            messages = self.conversation_history.copy()
             
             # 画像パスが含まれているか確認（例：「画像：path/to/image.jpg」の形式）
             if user_input.startswith('画像：'):
@@ -69,21 +62,25 @@ class ChatGPTAssistant:
                     "content": [{"type": "text", "text": user_input}]
                 }
 
-            messages.append(user_message)
+            messages = self.context_manager.build(
+                [{"role": "system", "content": GUIDE_SYSTEM_PROMPT}],
+                self.conversation_history + [user_message],
+                key='cli'
+            )
 
-            
-            # GPT-4による応答の生成
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
+            # 応答の生成
+            response = self.provider.chat(
+                'cli_chat',
+                messages,
                 max_tokens=500
             )
+            usage_tracker.record('cli_chat', response)
 
             # 応答を取得
             assistant_response = response.choices[0].message.content
 
-            # 会話履歴を更新
-            self.conversation_history.append(user_message)
+            # 会話履歴を更新（画像のbase64は履歴に残さない）
+            self.conversation_history.append(strip_images(user_message))
             self.conversation_history.append({
                 "role": "assistant",
                 "content": [{"type": "text", "text": assistant_response}]
@@ -103,22 +100,22 @@ class ChatGPTAssistant:
 
             # ファイル名に現在時刻を含める
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            audio_file = os.path.join(output_dir, f"response_{timestamp}.wav")
+            audio_file = os.path.join(output_dir, f"response_{timestamp}.mp3")
 
             if model == "gpt-4o-mini":
-              # テキストを音声に変換
-              tts = gTTS(text=text, lang='ja', slow=False)
-              tts.save(audio_file)
+              # テキストを音声に変換（同じテキストはキャッシュを再利用）
+              audio_content = self.provider.speech(text, engine='gtts')
               
             else:
               # GPT-4V-Audio-Previewによる音声生成
-              audio_response = self.client.audio.speech.create(
-                  model="tts-1",  # TTSモデルを使用
-                  voice=voice,   # 音声の種類
-                  input=text  # 生成したテキスト
+              audio_content = self.provider.speech(
+                  text,  # 生成したテキスト
+                  voice=voice   # 音声の種類
               )
-              # 音声を保存
-              audio_response.stream_to_file(audio_file)
+
+            # 音声を保存
+            with open(audio_file, 'wb') as f:
+                f.write(audio_content)
 
             return audio_file
 
@@ -128,6 +125,7 @@ class ChatGPTAssistant:
     def clear_conversation(self):
         """会話履歴をクリアする"""
         self.conversation_history = []
+        self.context_manager = ContextManager(summarizer=provider_summarizer(self.provider))
 
 
 # OpenAI APIキーを設定
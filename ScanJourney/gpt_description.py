@@ -1,14 +1,11 @@
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session
 import os
-from openai import OpenAI
 import requests
-from PIL import Image
-import io
-from gtts import gTTS
+from utils.image_preprocessor import ImagePreprocessor
+from utils.tts_cache import TTSCache
+from utils.providers import create_provider
+from utils.prompts import analysis_messages, usage_tracker, DESCRIPTION_INSTRUCTIONS, PLACE_INSTRUCTIONS
 from datetime import datetime
-import base64
-from PIL import Image
-import io
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key')
@@ -17,83 +14,40 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 class LocationImageAnalyzer:
     def __init__(self, openai_api_key):
-        self.client = OpenAI(api_key=openai_api_key)
+        self.provider = create_provider(
+            api_key=openai_api_key,
+            tts_cache=TTSCache(os.path.join("audio_output", ".tts_cache"))
+        )
+        self.image_preprocessor = ImagePreprocessor()
 
     def encode_image_to_base64(self, image_path):
         """画像をbase64エンコードする"""
-        with Image.open(image_path) as img:
-            # 画像サイズが大きい場合はリサイズ
-            max_size = 2048
-            if max(img.size) > max_size:
-                ratio = max_size / max(img.size)
-                new_size = tuple(int(dim * ratio) for dim in img.size)
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-
-            # 画像をJPEGフォーマットでバイト列に変換
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG')
-            img_byte_arr = img_byte_arr.getvalue()
-
-            # base64エンコード
-            base64_encoded = base64.b64encode(img_byte_arr).decode('utf-8')
-            return base64_encoded
+        # Webアプリと同じ前処理（回転補正・縮小・再エンコード）を使う
+        return self.image_preprocessor.prepare_file(image_path)['base64']
 
     def analyze_location_and_image(self, image_path, latitude, longitude, model, voice):
         """画像と位置情報を分析する"""
         try:
             # 画像をエンコード
             image_data = self.encode_image_to_base64(image_path)
-            messages = [
-                  {
-                      "role": "user",
-                      "content": [
-                          {
-                              "type": "text",
-                              "text": f"この画像は緯度{latitude}、経度{longitude}で撮影されました。"
-                                      f"画像の内容と撮影された場所について、名称を交えて詳しく説明してください。緯度と経度は説明に含めないでください。"
-                                      f"歴史的背景や周辺の観光スポット、危険な場所、治安についても具体的に触れてください。"
-                                      f"説明は日本語で、ガイドが観光客に説明するような親しみやすい口調でお願いします。"
-                          },
-                          {
-                              "type": "image_url",
-                              "image_url": {
-                                  "url": f"data:image/jpeg;base64,{image_data}"
-                              }
-                          }
-                      ]
-                  }
-              ]
-            
-            messages2 = [
-                  {
-                      "role": "user",
-                      "content": [
-                          {
-                              "type": "text",
-                              "text": f"緯度{latitude}、経度{longitude}で撮影されたこの場所の名前を、単語のみの形で答えてください。"
-                          },
-                          {
-                              "type": "image_url",
-                              "image_url": {
-                                  "url": f"data:image/jpeg;base64,{image_data}"
-                              }
-                          }
-                      ]
-                  }
-              ]
+            # Webアプリと同じプロンプト（共通の指示 → 画像 → 撮影地点）を使う
+            messages = analysis_messages(DESCRIPTION_INSTRUCTIONS, image_data, latitude, longitude)
+            messages2 = analysis_messages(PLACE_INSTRUCTIONS, image_data, latitude, longitude)
 
             # 画像分析の実行
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
+            response = self.provider.chat(
+                'description',
+                messages,
                 max_tokens=500
             )
+            usage_tracker.record('analysis.description', response)
 
-            response2 = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages2,
+            response2 = self.provider.chat(
+                'place',
+                messages2,
                 max_tokens=100
             )
+            usage_tracker.record('analysis.place', response2)
 
             if model == "gpt-4o-mini":
                 # GPT-4Vによる分析
@@ -107,10 +61,9 @@ class LocationImageAnalyzer:
                     place = response2.choices[0].message.content
 
                     # GPT-4V-Audio-Previewによる音声生成
-                    audio_response = self.client.audio.speech.create(
-                        model="tts-1",  # TTSモデルを使用
-                        voice=voice,   # 音声の種類
-                        input=description  # 生成したテキスト
+                    audio_content = self.provider.speech(
+                        description,  # 生成したテキスト
+                        voice=voice   # 音声の種類
                     )
 
                     # 出力ディレクトリが存在しない場合は作成
@@ -119,10 +72,11 @@ class LocationImageAnalyzer:
                         os.makedirs(output_dir)
                     # ファイル名に現在時刻を含める
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    audio_file = os.path.join(output_dir, f"description_{timestamp}.wav")
+                    audio_file = os.path.join(output_dir, f"description_{timestamp}.mp3")
 
                     # 音声を保存
-                    audio_response.stream_to_file(audio_file)
+                    with open(audio_file, 'wb') as f:
+                        f.write(audio_content)
 
                     print(f"音声ファイルを生成しました: {audio_file}")
                     return {"description": description, "audio_file": audio_file, "place": place}
@@ -142,11 +96,11 @@ class LocationImageAnalyzer:
 
             # ファイル名に現在時刻を含める
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            audio_file = os.path.join(output_dir, f"description_{timestamp}.wav")
+            audio_file = os.path.join(output_dir, f"description_{timestamp}.mp3")
 
-            # テキストを音声に変換
-            tts = gTTS(text=text, lang='ja', slow=False)
-            tts.save(audio_file)
+            # テキストを音声に変換（同じテキストはキャッシュを再利用）
+            with open(audio_file, 'wb') as f:
+                f.write(self.provider.speech(text, engine='gtts'))
 
             print(f"音声ファイルを生成しました: {audio_file}")
             return audio_file
@@ -9,6 +9,7 @@ class ChatManager {
         this.loading = document.getElementById('loading');
         this.errorMessage = document.getElementById('error-message');
         this.currentAudio = null;
+        this.audioQueue = [];
 
         this.initializeEventListeners();
         this.initialScroll();
@@ -38,14 +39,19 @@ class ChatManager {
         messageDiv.appendChild(contentDiv);
         
         if (timestamp) {
-            const timestampDiv = document.createElement('div');
-            timestampDiv.className = 'timestamp';
-            timestampDiv.textContent = this.formatTimestamp(timestamp);
-            messageDiv.appendChild(timestampDiv);
+            this.addTimestamp(messageDiv, timestamp);
         }
         
         this.chatMessages.appendChild(messageDiv);
         this.scrollToBottom();
+        return messageDiv;
+    }
+
+    addTimestamp(messageDiv, timestamp) {
+        const timestampDiv = document.createElement('div');
+        timestampDiv.className = 'timestamp';
+        timestampDiv.textContent = this.formatTimestamp(timestamp);
+        messageDiv.appendChild(timestampDiv);
     }
 
     scrollToBottom() {
@@ -70,7 +76,7 @@ class ChatManager {
         this.errorMessage.style.display = 'none';
 
         try {
-            const response = await fetch('/chat/message', {
+            const response = await fetch('/chat/message/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -81,13 +87,36 @@ class ChatManager {
                 })
             });
 
-            const data = await response.json();
-            if (data.success) {
-                this.updateChatHistory(data);
-                this.playAudioIfAvailable(data);
-            } else {
+            // 前の応答の読み上げは止める
+            this.stopAudio();
+
+            if (!response.ok || !response.body) {
+                const data = await response.json();
                 this.showError(data.error || 'エラーが発生しました。');
+                return;
             }
+
+            // ユーザーメッセージと、応答を書き込んでいく吹き出しを先に表示する
+            this.addMessage(message, 'user', new Date().toISOString());
+            const replyDiv = this.addMessage('', 'assistant');
+            const replyContent = replyDiv.firstChild;
+
+            await this.readEventStream(response, {
+                token: (data) => {
+                    this.loading.style.display = 'none';
+                    replyContent.textContent += data.content;
+                    this.scrollToBottom();
+                },
+                audio_chunk: (data) => {
+                    this.enqueueAudio(data.audio_file);
+                },
+                done: (data) => {
+                    this.addTimestamp(replyDiv, data.message.timestamp);
+                },
+                error: (data) => {
+                    this.showError(data.error || 'エラーが発生しました。');
+                }
+            });
         } catch (error) {
             this.showError('通信エラーが発生しました。');
         } finally {
@@ -96,20 +125,63 @@ class ChatManager {
         }
     }
 
-    updateChatHistory(data) {
-        this.chatMessages.innerHTML = '';
-        data.history.forEach(msg => {
-            this.addMessage(msg.content, msg.type, msg.timestamp);
-        });
-    }
+    async readEventStream(response, handlers) {
+        // Server-Sent Events を読み取り、イベント名ごとのハンドラを呼ぶ
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
 
-    playAudioIfAvailable(data) {
-        if (data.audio_file) {
-            if (this.currentAudio) {
-                this.currentAudio.pause();
+                let eventName = 'message';
+                let dataText = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) {
+                        eventName = line.slice(7);
+                    } else if (line.startsWith('data: ')) {
+                        dataText += line.slice(6);
+                    }
+                });
+
+                if (handlers[eventName]) {
+                    await handlers[eventName](JSON.parse(dataText));
+                }
             }
-            this.currentAudio = new Audio(data.audio_file);
-            this.currentAudio.play();
+        }
+    }
+
+    enqueueAudio(audioFile) {
+        // 文ごとの音声を順番に再生する
+        this.audioQueue.push(audioFile);
+        if (!this.currentAudio) {
+            this.playNextAudio();
+        }
+    }
+
+    playNextAudio() {
+        const audioFile = this.audioQueue.shift();
+        if (!audioFile) {
+            this.currentAudio = null;
+            return;
+        }
+        this.currentAudio = new Audio(audioFile);
+        this.currentAudio.addEventListener('ended', () => this.playNextAudio());
+        this.currentAudio.play().catch(() => this.playNextAudio());
+    }
+
+    stopAudio() {
+        this.audioQueue = [];
+        if (this.currentAudio) {
+            this.currentAudio.pause();
+            this.currentAudio = null;
         }
     }
 
@@ -118,7 +190,74 @@ class ChatManager {
     }
 }
 
+// 場所の説明の音声を文ごとに順番に再生する（合成中の撮影は、残りの文の音声ができるのを待って続ける）
+class DescriptionPlayer {
+    constructor(audio) {
+        this.audio = audio;
+        this.chunks = JSON.parse(audio.dataset.chunks);
+        this.status = audio.dataset.status;
+        this.statusUrl = audio.dataset.statusUrl;
+        this.index = 0;
+        this.waiting = false;
+
+        this.audio.addEventListener('ended', () => this.playNext());
+        if (this.chunks.length) {
+            this.audio.src = this.chunks[0];
+            // 撮影直後はすぐに再生を始める（自動再生が許可されない場合は再生ボタンで始める）
+            this.audio.play().catch(() => {});
+        }
+        if (this.status === 'pending') {
+            this.poll();
+        }
+    }
+
+    playNext() {
+        if (this.index + 1 < this.chunks.length) {
+            this.index += 1;
+            this.audio.src = this.chunks[this.index];
+            this.audio.play().catch(() => {});
+        } else if (this.status === 'pending') {
+            // 次の文の音声ができたら続きを再生する
+            this.waiting = true;
+        } else if (this.chunks.length) {
+            // 最後まで再生したら、次は最初の文から再生する
+            this.index = 0;
+            this.audio.src = this.chunks[0];
+        }
+    }
+
+    async poll() {
+        while (this.status === 'pending') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            let data;
+            try {
+                const response = await fetch(this.statusUrl, { cache: 'no-store' });
+                data = await response.json();
+            } catch (error) {
+                continue;
+            }
+            if (!data.success) {
+                return;
+            }
+            const hadChunks = this.chunks.length > 0;
+            this.chunks = data.chunks;
+            this.status = data.status;
+            if (!hadChunks && this.chunks.length) {
+                this.audio.src = this.chunks[0];
+                this.audio.play().catch(() => {});
+            } else if (this.waiting && this.index + 1 < this.chunks.length) {
+                this.waiting = false;
+                this.playNext();
+            }
+        }
+    }
+}
+
 // DOMの読み込み完了時に初期化
 document.addEventListener('DOMContentLoaded', () => {
     new ChatManager();
+    const descriptionAudio = document.getElementById('description-audio');
+    if (descriptionAudio) {
+        new DescriptionPlayer(descriptionAudio);
+    }
 });
\ No newline at end of file
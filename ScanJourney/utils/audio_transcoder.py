@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.capture_ids import new_capture_id
+
+try:
+    import av
+except ImportError:  # PyAV がない環境では再エンコードせず、拡張子の修正のみ行う
+    av = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 形式 -> (拡張子, MIMEタイプ)
+AUDIO_FORMATS = {
+    'mp3': ('mp3', 'audio/mpeg'),
+    'aac': ('aac', 'audio/aac'),
+    'm4a': ('m4a', 'audio/mp4'),
+    'opus': ('ogg', 'audio/ogg'),
+    'flac': ('flac', 'audio/flac'),
+    'wav': ('wav', 'audio/wav')
+}
+
+# 音声データを単純に連結しても再生できる形式
+CONCATENABLE_FORMATS = ('mp3', 'aac')
+
+def audio_extension(audio_format):
+    return AUDIO_FORMATS[audio_format][0]
+
+def audio_mimetype(path):
+    """ファイル名の拡張子から音声のMIMEタイプを返す"""
+    ext = os.path.splitext(path or '')[1].lstrip('.').lower()
+    for extension, mimetype in AUDIO_FORMATS.values():
+        if extension == ext:
+            return mimetype
+    return 'application/octet-stream'
+
+def sniff_audio_format(header):
+    """先頭のバイト列から実際の音声形式を判定する（不明なら None）"""
+    if header.startswith(b'ID3'):
+        return 'mp3'
+    if header.startswith(b'OggS'):
+        return 'opus'
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if len(header) >= 2 and header[0] == 0xFF and (header[1] & 0xE0) == 0xE0:
+        # MPEGフレームの同期ワード。layer ビットが 00 なら AAC(ADTS)
+        return 'aac' if (header[1] & 0x06) == 0 else 'mp3'
+    return None
+
+class AudioTranscoder:
+    """保存する音声を低ビットレートのAAC(.m4a)に再エンコードする
+
+    音声合成APIの出力(160kbpsのMP3)に比べ、声の読み上げなら24kbpsでも十分に聞き取れる。
+    """
+
+    def __init__(self, bitrate=24000, sample_rate=24000):
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.available = av is not None
+        self.output_format = 'm4a'
+
+    def transcode(self, src_path, dst_path):
+        """src_path の音声を dst_path に再エンコードする"""
+        tmp_path = f"{dst_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with av.open(src_path) as src, \
+                    av.open(tmp_path, 'w', format='mp4', options={'movflags': 'faststart'}) as dst:
+                # faststart で索引をファイル先頭に置き、ダウンロード途中からシークできるようにする
+                stream = dst.add_stream('aac', rate=self.sample_rate, layout='mono')
+                stream.bit_rate = self.bitrate
+                resampler = av.AudioResampler(
+                    format=stream.codec_context.format,
+                    layout='mono',
+                    rate=self.sample_rate
+                )
+                for frame in src.decode(audio=0):
+                    for resampled in resampler.resample(frame):
+                        dst.mux(stream.encode(resampled))
+                for resampled in resampler.resample(None):
+                    dst.mux(stream.encode(resampled))
+                dst.mux(stream.encode(None))
+            os.replace(tmp_path, dst_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def audio_references(image_data):
+    """撮影が参照している音声（全体の音声と文ごとの音声）"""
+    urls = list(image_data.get('audio_chunks') or ())
+    if image_data.get('audio_path'):
+        urls.append(image_data['audio_path'])
+    return urls
+
+def replace_audio(image_data, old_url, new_url):
+    """音声の参照を置き換えた画像データを返す"""
+    updated = dict(image_data)
+    if updated.get('audio_path') == old_url:
+        updated['audio_path'] = new_url
+    if updated.get('audio_chunks'):
+        updated['audio_chunks'] = [new_url if url == old_url else url for url in updated['audio_chunks']]
+    return updated
+
+class AudioCompressionJob:
+    """保存済みの音声を圧縮形式に変換し、メタデータの audio_path / audio_chunks を書き換える
+
+    PyAV があれば AAC に再エンコードし、なければ中身に合った拡張子へ付け替える。
+    変換後の音声は MediaStore に保存する。
+    元の音声は delete_after 秒たってから、どの撮影からも参照されていなければ削除する
+    （削除は次の変換のついでに行う。None なら削除しない）。
+    """
+
+    def __init__(self, metadata_manager, media_store, transcoder, delete_after=600):
+        self.metadata_manager = metadata_manager
+        self.media_store = media_store
+        self.transcoder = transcoder
+        self.delete_after = delete_after
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self._lock = threading.Lock()
+        # (削除してよい時刻, 元の音声のURL)
+        self._pending_deletes = []
+
+    def target_extension(self, src_path):
+        """変換後の拡張子（変換不要なら None）"""
+        with open(src_path, 'rb') as f:
+            actual_format = sniff_audio_format(f.read(16))
+        if actual_format is None:
+            return None
+
+        ext = os.path.splitext(src_path)[1].lstrip('.').lower()
+        if self.transcoder.available and actual_format != self.transcoder.output_format:
+            return audio_extension(self.transcoder.output_format)
+        if ext != audio_extension(actual_format):
+            return audio_extension(actual_format)
+        return None
+
+    def compress(self, audio_url):
+        """1つの音声ファイルを変換し、参照しているメタデータを更新する。新しいURLを返す（元の音声は後で削除する）"""
+        with self.media_store.local_file(audio_url) as src_path:
+            if not src_path:
+                return None
+            extension = self.target_extension(src_path)
+            if extension is None:
+                return None
+
+            if self.transcoder.available and extension == audio_extension(self.transcoder.output_format):
+                tmp_path = self.media_store.incoming_path(f"audio_{new_capture_id()}.{extension}")
+                self.transcoder.transcode(src_path, tmp_path)
+                new_url = self.media_store.put_file(tmp_path, extension)
+            else:
+                # メタデータを書き換えるまでは元のURLでも配信できるよう、コピーを保存する
+                new_url = self.media_store.put_file(src_path, extension, move=False)
+
+        # 同じ音声を共有している撮影（位置キャッシュの再利用分）もまとめて書き換える。
+        # 書き換え中に追加された参照も拾うため、参照がなくなるまで繰り返す
+        while True:
+            referencing = self.metadata_manager.get_images_by_audio_path(audio_url)
+            if not referencing:
+                break
+            for image_id, image_data in referencing:
+                self.metadata_manager.update_image_data(image_id, replace_audio(image_data, audio_url, new_url))
+
+        # 配ったURL（ジョブの結果や表示済みのチャット画面、キャッシュさせた /media のレスポンス）が
+        # しばらく使えるよう、元の音声はすぐには消さない
+        if self.delete_after is not None:
+            with self._lock:
+                self._pending_deletes.append((time.time() + self.delete_after, audio_url))
+        return new_url
+
+    def delete_sources(self, force=False):
+        """削除を待っている元の音声のうち、期限が過ぎて参照がなくなったものを削除する
+
+        内容ハッシュで重複をまとめているため、同じ音声を別の撮影が使っていれば残す。
+        force=True なら期限を待たない。削除した件数を返す。
+        """
+        now = time.time()
+        with self._lock:
+            due = [url for deadline, url in self._pending_deletes if force or deadline <= now]
+            self._pending_deletes = [
+                (deadline, url) for deadline, url in self._pending_deletes if not (force or deadline <= now)
+            ]
+        deleted = 0
+        for audio_url in due:
+            if self.metadata_manager.get_images_by_audio_path(audio_url):
+                continue
+            try:
+                self.media_store.delete(audio_url)
+                deleted += 1
+            except Exception as e:
+                print(f"元の音声の削除に失敗しました ({audio_url}): {str(e)}")
+        return deleted
+
+    def submit(self, audio_url):
+        """バックグラウンドで変換する"""
+        return self.executor.submit(self._compress_logged, audio_url)
+
+    def _compress_logged(self, audio_url):
+        self.delete_sources()
+        try:
+            return self.compress(audio_url)
+        except Exception as e:
+            print(f"音声の変換に失敗しました ({audio_url}): {str(e)}")
+            return None
+
+    def migrate(self):
+        """保存済みの全撮影の音声を変換する（他プロセスが実行中なら何もしない）"""
+        lock = open(os.path.join(self.media_store.upload_folder, '.audio_migration.lock'), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return 0
+
+            audio_urls = set()
+            for _, image_data in self.metadata_manager.get_images_by_timestamp():
+                audio_urls.update(audio_references(image_data))
+            converted = 0
+            for audio_url in sorted(audio_urls):
+                if self._compress_logged(audio_url):
+                    converted += 1
+            # 移行は明示的に実行するので、元の音声は待たずに削除する
+            self.delete_sources(force=True)
+            return converted
+        finally:
+            lock.close()
+
+    def start_migration(self):
+        """全撮影の音声の変換をバックグラウンドで開始する"""
+        return self.executor.submit(self.migrate)
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# ULID で使う Crockford の Base32（I, L, O, U を含まない）
+_CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_RANDOM_BITS = 80
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+def new_capture_id():
+    """撮影ごとのID（ULID）を作る
+
+    先頭48ビットがミリ秒単位の時刻、残り80ビットが乱数の26文字で、文字列の順が作成順になる。
+    同じミリ秒に複数作った場合は乱数部分を1ずつ増やし、同じプロセス内でも順序と一意性を保つ。
+    別のプロセス・サーバーとは80ビットの乱数で衝突を避ける。
+    """
+    global _last_ms, _last_random
+    with _lock:
+        ms = int(time.time() * 1000)
+        if ms <= _last_ms:
+            ms = _last_ms
+            random_part = _last_random + 1
+            if random_part >> _RANDOM_BITS:
+                # 同じミリ秒で乱数部分を使い切ったら次のミリ秒に進める
+                ms += 1
+                random_part = int.from_bytes(os.urandom(_RANDOM_BITS // 8), 'big')
+        else:
+            random_part = int.from_bytes(os.urandom(_RANDOM_BITS // 8), 'big')
+        _last_ms, _last_random = ms, random_part
+
+    value = (ms << _RANDOM_BITS) | random_part
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD_BASE32[value & 0x1f])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+@contextmanager
+def atomic_target(path):
+    """一時ファイルのパスを渡し、ブロックを抜けたら path にリネームする（失敗時は一時ファイルを消す）
+
+    書き込み途中のファイルが配信されたり、同じ名前の別のファイルと混ざったりしない。
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write(path, content):
+    """バイト列を一時ファイルに書き出してから path にリネームする"""
+    with atomic_target(path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    image_id TEXT,
+    context TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+class Conversation:
+    """メモリ上に保持する1つの会話（コンテキストと履歴）"""
+
+    def __init__(self, context, history):
+        self.context = context
+        self.history = history
+        self.last_access = time.time()
+
+class ChatStore:
+    """チャットの会話をサーバー側に保存するストア
+
+    会話はIDで識別し、ブラウザのセッションにはIDだけを持たせる。
+    メッセージは SQLite に1件ずつ追記し、最近使った会話はメモリ上に保持する（LRU + 有効期限）。
+    他のプロセスが追記したメッセージは、差分だけを読み込んで反映する。
+    """
+
+    def __init__(self, db_file, max_conversations=1000, ttl=30 * 60,
+                 retention=30 * 24 * 60 * 60, timeout=30.0):
+        self.db_file = db_file
+        self.max_conversations = max_conversations
+        # メモリ上の会話は ttl 秒使われなければ破棄する（SQLite には retention 秒残す）
+        self.ttl = ttl
+        self.retention = retention
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # 会話ID -> Conversation（古い順）
+        self._local = threading.local()
+        self._last_purge = 0
+
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        """スレッドごとに接続を使い回す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    def create(self, context, history=()):
+        """会話を作成し、会話IDを返す"""
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "INSERT INTO conversations (id, image_id, context, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, context.get('image_id'), json.dumps(context, ensure_ascii=False), now, now)
+            )
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, seq, data) VALUES (?, ?, ?)",
+                [(conversation_id, seq, json.dumps(message, ensure_ascii=False)) for seq, message in enumerate(history)]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        with self._lock:
+            self._remember(conversation_id, Conversation(context, list(history)))
+        self._purge_if_due()
+        return conversation_id
+
+    def _remember(self, conversation_id, conversation):
+        """メモリ上のキャッシュに追加し、上限を超えた分を古い順に破棄する（ロック取得済みで呼ぶ）"""
+        self._cache[conversation_id] = conversation
+        self._cache.move_to_end(conversation_id)
+        while len(self._cache) > self.max_conversations:
+            self._cache.popitem(last=False)
+
+    def _load(self, conversation_id):
+        """会話を取得する（なければ None）。キャッシュ済みなら追記された差分だけを読み込む"""
+        now = time.time()
+        with self._lock:
+            conversation = self._cache.get(conversation_id)
+            if conversation is not None and now - conversation.last_access > self.ttl:
+                del self._cache[conversation_id]
+                conversation = None
+
+        conn = self._connect()
+        if conversation is None:
+            row = conn.execute("SELECT context FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is None:
+                return None
+            conversation = Conversation(json.loads(row[0]), [])
+
+        known = len(conversation.history)
+        new_messages = [
+            json.loads(data) for (data,) in conn.execute(
+                "SELECT data FROM messages WHERE conversation_id = ? AND seq >= ? ORDER BY seq",
+                (conversation_id, known)
+            )
+        ]
+
+        with self._lock:
+            # 他のスレッドが同時に読み込んだ場合に二重に追加しない
+            if len(conversation.history) == known:
+                conversation.history.extend(new_messages)
+            conversation.last_access = now
+            self._remember(conversation_id, conversation)
+        return conversation
+
+    def get_context(self, conversation_id):
+        """会話のコンテキスト（場所・説明など）を返す（なければ None）"""
+        conversation = self._load(conversation_id) if conversation_id else None
+        return conversation.context if conversation else None
+
+    def get_history(self, conversation_id):
+        """会話の履歴のコピーを返す（なければ空のリスト）"""
+        conversation = self._load(conversation_id) if conversation_id else None
+        return list(conversation.history) if conversation else []
+
+    def append(self, conversation_id, message):
+        """会話の末尾にメッセージを1件追記する"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "INSERT INTO messages (conversation_id, seq, data) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ? FROM messages WHERE conversation_id = ?",
+                (conversation_id, json.dumps(message, ensure_ascii=False), conversation_id)
+            )
+            conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (time.time(), conversation_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        # 追記した分（と他プロセスの追記分）をメモリ上の履歴に反映する
+        self._load(conversation_id)
+
+    def _purge_if_due(self):
+        """保存期間を過ぎた会話を削除する（1時間に1回まで）"""
+        now = time.time()
+        if now - self._last_purge < 60 * 60:
+            return
+        self._last_purge = now
+
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            expired = "SELECT id FROM conversations WHERE updated_at < ?"
+            conn.execute(f"DELETE FROM messages WHERE conversation_id IN ({expired})", (now - self.retention,))
+            conn.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.retention,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached_conversations': len(self._cache),
+                'max_conversations': self.max_conversations
+            }
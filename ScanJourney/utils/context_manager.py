@@ -0,0 +1,207 @@
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils.prompts import usage_tracker
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:  # tiktoken がない（またはエンコーディングを読み込めない）環境では概算する
+    _encoding = None
+
+# 過去の画像は高解像度1枚分として見積もる（512pxタイル4枚 + 基本分）
+IMAGE_TOKENS = 765
+# メッセージごとの役割・区切りの分
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# ASCII の単語・記号と、それ以外（日本語など）の文字
+_ASCII_RUN = re.compile(r'[\x00-\x7f]+')
+
+def estimate_tokens(text):
+    """テキストのトークン数を手元で見積もる"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # 英数字はおよそ4文字で1トークン、日本語はおよそ1文字で1トークン
+    ascii_chars = sum(len(run) for run in _ASCII_RUN.findall(text))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def message_tokens(message):
+    """1つのメッセージのトークン数の見積もり"""
+    content = message.get('content')
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get('type') == 'image_url':
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(part.get('text', ''))
+    else:
+        tokens = estimate_tokens(content or '')
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+def strip_images(message):
+    """メッセージ中の画像を文字列の目印に置き換えたコピーを返す（画像がなければそのまま返す）"""
+    content = message.get('content')
+    if not isinstance(content, list) or not any(part.get('type') == 'image_url' for part in content):
+        return message
+    return dict(message, content=[
+        {'type': 'text', 'text': '[画像]'} if part.get('type') == 'image_url' else part
+        for part in content
+    ])
+
+def message_text(message):
+    """要約用にメッセージの本文だけを取り出す"""
+    content = message.get('content')
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if part.get('type') == 'text')
+    return content or ''
+
+def provider_summarizer(provider, max_tokens=300):
+    """プロバイダーの要約用モデル（処理名 'summary'）で会話を要約する関数を返す"""
+    def summarize(previous_summary, messages):
+        transcript = '\n'.join(
+            f"{'ガイド' if message['role'] == 'assistant' else '利用者'}: {message_text(message)}"
+            for message in messages
+        )
+        prompt = (
+            "以下は観光ガイドと利用者の会話です。これまでの要約と新しいやり取りをまとめ、"
+            "利用者の関心・質問済みの内容・ガイドが伝えた事実を簡潔な日本語で要約してください。\n\n"
+            f"これまでの要約:\n{previous_summary or 'なし'}\n\n新しいやり取り:\n{transcript}"
+        )
+        response = provider.chat(
+            'summary',
+            [{"role": "user", "content": prompt}],
+            max_tokens=max_tokens
+        )
+        usage_tracker.record('chat.summary', response)
+        return response.choices[0].message.content
+    return summarize
+
+class ContextManager:
+    """チャットで送るメッセージをトークン数の上限内に収める
+
+    - 最新のメッセージ以外に含まれる画像は目印の文字列に置き換える
+    - 上限を超える分は古いやり取りから送らないようにする
+    - summarizer があれば、送らなくなったやり取りをバックグラウンドで要約し、次回から要約として送る
+    1ターンあたりに送るトークン数がほぼ一定になるため、会話が長くなっても応答時間が伸びない。
+    """
+
+    def __init__(self, budget=3000, keep_recent=2, summarizer=None, max_conversations=1000):
+        self.budget = budget
+        # 上限を超えても最新の keep_recent 件は必ず送る
+        self.keep_recent = keep_recent
+        self.summarizer = summarizer
+        self.max_conversations = max_conversations
+
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()  # 会話キー -> (要約済みの件数, 要約)
+        self._summarizing = set()
+        self._executor = ThreadPoolExecutor(max_workers=1) if summarizer else None
+        self._metrics = {
+            'turns': 0,
+            'tokens_full': 0,
+            'tokens_sent': 0,
+            'messages_trimmed': 0,
+            'images_stripped': 0,
+            'summaries': 0,
+            'summary_errors': 0
+        }
+
+    def _summary_state(self, key):
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        return 0, None
+
+    def _summary_message(self, summary):
+        return {"role": "system", "content": f"これまでの会話の要約：\n{summary}"}
+
+    def build(self, system_messages, history, key=None):
+        """送信するメッセージのリストを作る
+
+        system_messages: 毎回そのまま先頭に置くメッセージ
+        history: OpenAI 形式の会話履歴（最後が今回の利用者のメッセージ）
+        key: 会話を識別するキー（要約を会話ごとに保持するため）
+        """
+        full_tokens = sum(message_tokens(message) for message in system_messages + history)
+
+        # 最新のメッセージ以外の画像は送らない
+        stripped = [strip_images(message) for message in history[:-1]] + history[-1:]
+        images_stripped = sum(1 for before, after in zip(history, stripped) if before is not after)
+
+        available = self.budget - sum(message_tokens(message) for message in system_messages)
+        tokens = [message_tokens(message) for message in stripped]
+
+        # 新しいものから順に、上限に収まるところまで含める
+        start = len(stripped)
+        used = 0
+        while start > 0:
+            needed = tokens[start - 1]
+            if used + needed > available and len(stripped) - start >= self.keep_recent:
+                break
+            used += needed
+            start -= 1
+
+        summarized_count, summary = self._summary_state(key)
+        prefix = []
+        if start > 0 and summary:
+            # 要約の分だけ、さらに古いものから外す
+            summary_message = self._summary_message(summary)
+            used += message_tokens(summary_message)
+            while used > available and len(stripped) - start > self.keep_recent:
+                used -= tokens[start]
+                start += 1
+            prefix = [summary_message]
+
+        messages = system_messages + prefix + stripped[start:]
+
+        if start > summarized_count and self.summarizer and key is not None:
+            self._schedule_summary(key, summary, summarized_count, stripped[summarized_count:start], start)
+
+        with self._lock:
+            self._metrics['turns'] += 1
+            self._metrics['tokens_full'] += full_tokens
+            self._metrics['tokens_sent'] += sum(message_tokens(message) for message in messages)
+            self._metrics['messages_trimmed'] += start
+            self._metrics['images_stripped'] += images_stripped
+        return messages
+
+    def _schedule_summary(self, key, previous_summary, summarized_count, messages, new_count):
+        """送らなくなったやり取りの要約をバックグラウンドで更新する"""
+        with self._lock:
+            if key in self._summarizing:
+                return
+            self._summarizing.add(key)
+
+        def run():
+            try:
+                summary = self.summarizer(previous_summary, messages)
+                with self._lock:
+                    current_count = self._summaries.get(key, (0, None))[0]
+                    if current_count == summarized_count:
+                        self._summaries[key] = (new_count, summary)
+                        self._summaries.move_to_end(key)
+                        while len(self._summaries) > self.max_conversations:
+                            self._summaries.popitem(last=False)
+                        self._metrics['summaries'] += 1
+            except Exception as e:
+                print(f"会話の要約に失敗しました: {str(e)}")
+                with self._lock:
+                    self._metrics['summary_errors'] += 1
+            finally:
+                with self._lock:
+                    self._summarizing.discard(key)
+
+        self._executor.submit(run)
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['tokens_saved'] = metrics['tokens_full'] - metrics['tokens_sent']
+        metrics['budget'] = self.budget
+        metrics['average_tokens_sent'] = metrics['tokens_sent'] / metrics['turns'] if metrics['turns'] else 0.0
+        return metrics
@@ -0,0 +1,85 @@
+import math
+
+from PIL import Image, ImageOps
+
+EARTH_RADIUS_M = 6371000
+
+def image_hash(image_file, hash_size=8):
+    """知覚ハッシュ(dHash)を16進文字列で返す。似た画像ほどハミング距離が小さくなる"""
+    with Image.open(image_file) as img:
+        img = ImageOps.exif_transpose(img).convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+        pixels = list(img.getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def hash_distance(hash_a, hash_b):
+    """2つの知覚ハッシュのハミング距離"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+def distance_m(lat1, lng1, lat2, lng2):
+    """2点間の距離(m)（ハーバーサイン公式）"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def bounding_box(latitude, longitude, radius_m):
+    """中心から radius_m 以内を含む (最小緯度, 最大緯度, 最小経度, 最大経度)"""
+    d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+    d_lng = math.degrees(radius_m / (EARTH_RADIUS_M * max(math.cos(math.radians(latitude)), 1e-6)))
+    return latitude - d_lat, latitude + d_lat, longitude - d_lng, longitude + d_lng
+
+class GeoCache:
+    """近くで撮影された似た画像の分析結果を探す
+
+    メタデータの緯度・経度で候補を絞り込み、知覚ハッシュで同じ被写体かどうかを判定する。
+    """
+
+    def __init__(self, metadata_manager, media_store, radius_m=50, max_hash_distance=10):
+        self.metadata_manager = metadata_manager
+        self.media_store = media_store
+        self.radius_m = radius_m
+        self.max_hash_distance = max_hash_distance
+
+    def _candidate_hash(self, image_id, image_data):
+        """候補画像の知覚ハッシュ（古い画像は初回に計算して保存する）"""
+        if image_data.get('image_hash'):
+            return image_data['image_hash']
+
+        with self.media_store.local_file(image_data.get('image_path')) as image_file:
+            if not image_file:
+                return None
+            try:
+                candidate_hash = image_hash(image_file)
+            except OSError:
+                return None
+        self.metadata_manager.update_image_data(image_id, dict(image_data, image_hash=candidate_hash))
+        return candidate_hash
+
+    def find(self, latitude, longitude, query_hash):
+        """条件に合う過去の撮影のうち最も近いものを (画像ID, 画像データ, 距離m) で返す"""
+        candidates = self.metadata_manager.get_images_near(*bounding_box(latitude, longitude, self.radius_m))
+
+        best = None
+        for image_id, image_data in candidates:
+            if not image_data.get('description') or not (image_data.get('audio_path') or image_data.get('audio_chunks')):
+                continue
+            # 音声を合成中（または途中で失敗した）撮影は使わない
+            if image_data.get('audio_status', 'done') != 'done':
+                continue
+            distance = distance_m(latitude, longitude, image_data['latitude'], image_data['longitude'])
+            if distance > self.radius_m:
+                continue
+            candidate_hash = self._candidate_hash(image_id, image_data)
+            if candidate_hash is None or hash_distance(query_hash, candidate_hash) > self.max_hash_distance:
+                continue
+            if best is None or distance < best[2]:
+                best = (image_id, image_data, distance)
+        return best
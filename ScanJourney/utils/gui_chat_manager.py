@@ -1,25 +1,22 @@
 import tkinter as tk
 from tkinter import scrolledtext
 from threading import Thread
-from openai import OpenAI
 import queue
+from utils.context_manager import ContextManager, provider_summarizer
+from utils.prompts import guide_chat_messages, usage_tracker
 
 class GuiChatManager:
-    def __init__(self, openai_client, place_name, description):
-        self.openai_client = openai_client
+    def __init__(self, provider, place_name, description):
+        self.provider = provider
         self.messages_queue = queue.Queue()
         self.root = None
         self.chat_window = None
         self.user_entry = None
-        self.messages = [
-            {
-                "role": "system",
-                "content": (
-                    f"あなたは{place_name}の観光ガイドです。"
-                    f"以下の説明に基づいて回答してください：\n{description}"
-                )
-            }
-        ]
+        # 送信時は上限のトークン数に収まるよう、古いやり取りを要約・省略する
+        self.context_manager = ContextManager(summarizer=provider_summarizer(provider))
+        # Webのチャットと同じ先頭部分にして、プロンプトキャッシュを共有する
+        self.system_messages = guide_chat_messages(place_name, description)
+        self.messages = []
 
     def create_window(self):
         self.root = tk.Tk()
@@ -77,11 +74,12 @@ class GuiChatManager:
     def get_bot_response(self):
         try:
             # GPT-4からの応答を取得
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=self.messages,
+            response = self.provider.chat(
+                'chat',
+                self.context_manager.build(self.system_messages, self.messages, key='gui'),
                 max_tokens=500
             )
+            usage_tracker.record('gui_chat', response)
 
             bot_message = response.choices[0].message.content
             self.messages.append({"role": "assistant", "content": bot_message})
@@ -89,11 +87,7 @@ class GuiChatManager:
             # 音声生成（オプション）
             if self.audio_var.get():
                 try:
-                    audio_response = self.openai_client.audio.speech.create(
-                        model="tts-1",
-                        voice="nova",
-                        input=bot_message
-                    )
+                    audio_content = self.provider.speech(bot_message)
                     # 音声の再生（実装は省略）
                 except Exception as e:
                     print(f"音声生成エラー: {str(e)}")
@@ -113,8 +107,8 @@ class GuiChatManager:
         self.create_window()
         self.root.mainloop()
 
-def launch_gui_chat(openai_client, place_name, description):
+def launch_gui_chat(provider, place_name, description):
     """GUIチャットを別スレッドで起動する関数"""
-    chat_manager = GuiChatManager(openai_client, place_name, description)
+    chat_manager = GuiChatManager(provider, place_name, description)
     Thread(target=chat_manager.run).start()
     return chat_manager
\ No newline at end of file
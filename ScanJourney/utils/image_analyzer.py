@@ -1,95 +1,167 @@
 # utils/image_analyzer.py
 
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.speech_pipeline import SpeechPipeline
+from utils.prompts import (
+    analysis_messages,
+    usage_tracker,
+    DESCRIPTION_INSTRUCTIONS,
+    PLACE_INSTRUCTIONS,
+    STRUCTURED_INSTRUCTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+# 説明と名称を1回のリクエストで受け取るためのJSONスキーマ
+ANALYSIS_SCHEMA = {
+    "name": "place_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "place": {"type": "string"}
+        },
+        "required": ["description", "place"],
+        "additionalProperties": False
+    }
+}
 
 class ImageAnalyzer:
-    def __init__(self, client):
-        self.client = client
+    # 分析モード: 'structured' は1回の構造化リクエスト、'separate' は説明と名称を別々に取得
+    MODES = ('structured', 'separate')
 
-    def analyze_image(self, image_data, latitude, longitude):
-        """画像を分析し、場所の説明と名称を取得する"""
+    def __init__(self, provider, max_workers=4, mode='structured', speech_pipeline=None):
+        if mode not in self.MODES:
+            raise ValueError(f"不明な分析モードです: {mode}")
+        self.provider = provider
+        self.mode = mode
+        # 説明文は文ごとに並列で音声合成する
+        self.speech_pipeline = speech_pipeline or SpeechPipeline(provider)
+        # 説明・名称・音声の各リクエストを並行実行するためのスレッドプール
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _timed(self, timings, stage, func, *args, **kwargs):
+        """処理を実行し、所要時間(秒)を timings[stage] に記録する"""
+        start = time.perf_counter()
         try:
-            # 詳細な説明を取得するためのメッセージ
-            description_prompt = (
-                f"この画像は緯度{latitude}、経度{longitude}で撮影されました。"
-                f"画像の内容と撮影された場所について、名称を交えて詳しく説明してください。緯度と経度は説明に含めないでください。"
-                f"歴史的背景や周辺の観光スポット、危険な場所、治安、注意点についても具体的に触れてください。"
-                f"説明は日本語で、ガイドが観光客に説明するような親しみやすい口調でお願いします。"
-            )
-
-            # 場所の名称のみを取得するためのメッセージ
-            place_prompt = (
-                f"緯度{latitude}、経度{longitude}で撮影されたこの場所の名前を、"
-                f"単語のみの形で答えてください。"
-            )
-
-            # メッセージの構築
-            description_message = {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": description_prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_data}"
-                        }
-                    }
-                ]
-            }
+            return func(*args, **kwargs)
+        finally:
+            timings[stage] = time.perf_counter() - start
 
-            place_message = {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": place_prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_data}"
-                        }
-                    }
-                ]
-            }
+    def _request_description(self, description_messages):
+        """詳細な説明を取得する"""
+        response = self.provider.chat(
+            'description',
+            description_messages,
+            max_tokens=500
+        )
+        usage_tracker.record('analysis.description', response)
+        return response.choices[0].message.content
+
+    def _request_place(self, place_messages):
+        """場所の名称を取得する"""
+        response = self.provider.chat(
+            'place',
+            place_messages,
+            max_tokens=100
+        )
+        usage_tracker.record('analysis.place', response)
+        return response.choices[0].message.content.strip()
+
+    def _request_structured(self, messages):
+        """説明と名称をJSON形式でまとめて取得する"""
+        response = self.provider.chat(
+            'analysis',
+            messages,
+            max_tokens=600,
+            response_format={"type": "json_schema", "json_schema": ANALYSIS_SCHEMA}
+        )
+        usage_tracker.record('analysis.structured', response)
+        return self._parse_structured(response.choices[0].message.content)
+
+    def _parse_structured(self, content):
+        """構造化レスポンスを解析する（失敗時は ValueError）"""
+        try:
+            parsed = json.loads(content or '')
+        except json.JSONDecodeError as e:
+            raise ValueError(f"構造化レスポンスの解析に失敗しました: {e}")
 
-            # APIリクエストの実行
-            description_response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[description_message],
-                max_tokens=500
-            )
+        if not isinstance(parsed, dict):
+            raise ValueError("構造化レスポンスの形式が不正です")
+        description = parsed.get('description')
+        place = parsed.get('place')
+        if not isinstance(description, str) or not isinstance(place, str) \
+                or not description.strip() or not place.strip():
+            raise ValueError("構造化レスポンスに説明または名称が含まれていません")
+        return description, place.strip()
 
-            place_response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[place_message],
-                max_tokens=100
-            )
+    def _request_speech(self, description):
+        """説明文の文ごとの音声合成を開始し、結果を順番に取り出す SpeechQueue を返す（完了は待たない）"""
+        # 音声生成用のテキストをUTF-8でエンコード
+        description_for_audio = description.encode('utf-8').decode('utf-8')
+
+        return self.speech_pipeline.start(description_for_audio)
+
+    def _describe_and_speak(self, description_messages, timings):
+        """説明の取得が終わり次第、続けて音声生成を始める"""
+        description = self._timed(timings, 'description', self._request_description, description_messages)
+        return description, self._request_speech(description)
+
+    def _analyze_structured(self, image_data, latitude, longitude, timings):
+        """1回の構造化リクエストで説明と名称を取得し、音声を生成する"""
+        messages = analysis_messages(STRUCTURED_INSTRUCTIONS, image_data, latitude, longitude)
+
+        description, place = self._timed(timings, 'analysis', self._request_structured, messages)
+        return description, place, self._request_speech(description)
+
+    def _analyze_separate(self, image_data, latitude, longitude, timings):
+        """説明→音声生成の流れと名称の取得を並行して実行する"""
+        description_messages = analysis_messages(DESCRIPTION_INSTRUCTIONS, image_data, latitude, longitude)
+        place_messages = analysis_messages(PLACE_INSTRUCTIONS, image_data, latitude, longitude)
+
+        description_future = self.executor.submit(self._describe_and_speak, description_messages, timings)
+        place_future = self.executor.submit(self._timed, timings, 'place', self._request_place, place_messages)
+
+        description, speech = description_future.result()
+        place = place_future.result()
+        return description, place, speech
+
+    def analyze_image(self, image_data, latitude, longitude):
+        """画像を分析し、場所の説明と名称を取得する（音声は speech から文ごとに取り出す）"""
+        try:
+            timings = {}
+            start = time.perf_counter()
+            mode = self.mode
 
-            description = description_response.choices[0].message.content
-            place = place_response.choices[0].message.content.strip()
+            if mode == 'structured':
+                try:
+                    description, place, speech = self._analyze_structured(
+                        image_data, latitude, longitude, timings)
+                except ValueError as e:
+                    # 解析に失敗した場合は従来の2回リクエストで取得し直す
+                    logger.warning("構造化分析に失敗したため個別リクエストに切り替えます: %s", e)
+                    mode = 'separate'
 
-            # 音声生成用のテキストをUTF-8でエンコード
-            description_for_audio = description.encode('utf-8').decode('utf-8')
+            if mode == 'separate':
+                description, place, speech = self._analyze_separate(
+                    image_data, latitude, longitude, timings)
 
-            # 音声の生成
-            audio_response = self.client.audio.speech.create(
-                model="tts-1",
-                voice="nova",
-                input=description_for_audio
-            )
+            timings['total'] = time.perf_counter() - start
 
             return {
                 'description': description,
                 'place': place,
-                'audio_response': audio_response
+                'speech': speech,
+                'timings': timings,
+                'mode': mode
             }
 
         except Exception as e:
             import traceback
             error_detail = traceback.format_exc()
             print(f"Error details: {error_detail}")  # デバッグ用
-            raise Exception(f"画像分析エラー: {str(e)}\n{error_detail}")
\ No newline at end of file
+            raise Exception(f"画像分析エラー: {str(e)}\n{error_detail}")
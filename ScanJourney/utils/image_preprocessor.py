@@ -0,0 +1,66 @@
+import base64
+import io
+
+from PIL import Image, ImageOps
+
+class ImagePreprocessor:
+    """画像をビジョンモデルへ送る前に縮小・再エンコードする
+
+    ビジョンモデルは長辺2048px・短辺768pxに収まるよう縮小してから512pxのタイルに分割するため、
+    それより大きな画像を送っても精度は変わらず、転送量とトークンだけが増える。
+    """
+
+    def __init__(self, max_edge=2048, max_short_edge=768, quality=85):
+        self.max_edge = max_edge
+        self.max_short_edge = max_short_edge
+        self.quality = quality
+
+    def prepare(self, image_bytes):
+        """画像バイト列を受け取り、送信用のJPEGと統計情報を返す"""
+        with Image.open(io.BytesIO(image_bytes)) as original:
+            original_format = original.format
+            # EXIFの回転情報を画素に反映する
+            rotated = original.getexif().get(0x0112, 1) != 1
+            img = ImageOps.exif_transpose(original)
+            width, height = img.size
+
+            scale = min(
+                1.0,
+                self.max_edge / max(width, height),
+                self.max_short_edge / min(width, height)
+            )
+            resized = scale < 1.0
+            if resized:
+                new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+            prepared = buffer.getvalue()
+            size = img.size
+
+        # 縮小も回転も不要なJPEGは、再エンコードで大きくなるなら元のまま使う
+        if not resized and not rotated and original_format == 'JPEG' and len(image_bytes) <= len(prepared):
+            prepared = image_bytes
+
+        return {
+            'data': prepared,
+            'width': size[0],
+            'height': size[1],
+            'bytes_before': len(image_bytes),
+            'bytes_after': len(prepared)
+        }
+
+    def prepare_base64(self, image_bytes):
+        """prepare() の結果に base64 文字列を加えて返す"""
+        result = self.prepare(image_bytes)
+        result['base64'] = base64.b64encode(result['data']).decode('utf-8')
+        return result
+
+    def prepare_file(self, image_path):
+        """画像ファイルを読み込んで prepare_base64() する"""
+        with open(image_path, 'rb') as f:
+            return self.prepare_base64(f.read())
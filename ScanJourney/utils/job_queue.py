@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress TEXT,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at);
+"""
+
+# 完了したジョブの状態（これ以上変わらない）
+FINISHED_STATUSES = ('done', 'failed', 'canceled')
+
+class JobQueue:
+    """SQLite(WALモード)に保存するジョブキュー
+
+    submit() でジョブを登録すると、ワーカースレッドが順に取り出して handler(payload, report) を実行する。
+    handler は report(progress, result=None) で進捗と途中の結果を知らせられる。
+    キューはファイルに残るため、プロセスが再起動しても未処理のジョブは失われない。
+    複数の gunicorn ワーカーが同じファイルを使う場合は、空いているプロセスがジョブを取り出す。
+    """
+
+    def __init__(self, db_file, handler, max_workers=2, poll_interval=1.0,
+                 stale_after=600, max_attempts=3, keep_seconds=24 * 60 * 60, timeout=30.0):
+        self.db_file = db_file
+        self.handler = handler
+        self.poll_interval = poll_interval
+        # 更新がこの秒数途絶えた実行中ジョブは、落ちたプロセスのものとみなして再実行する
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.keep_seconds = keep_seconds
+        self.timeout = timeout
+        self.owner = f"{os.uname().nodename if hasattr(os, 'uname') else ''}:{os.getpid()}"
+
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+        self._workers = []
+        for index in range(max_workers):
+            worker = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _connect(self):
+        """スレッドごとに接続を使い回す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    def submit(self, payload):
+        """ジョブを登録し、ジョブIDを返す"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (id, status, progress, payload, created_at, updated_at) "
+            "VALUES (?, 'queued', 'queued', ?, ?, ?)",
+            (job_id, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態を辞書で返す（存在しなければ None）"""
+        row = self._connect().execute(
+            "SELECT id, status, progress, payload, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row[0],
+            'status': row[1],
+            'progress': row[2],
+            'payload': json.loads(row[3]),
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5],
+            'created_at': row[6],
+            'updated_at': row[7]
+        }
+
+    def cancel(self, job_id):
+        """まだ実行が始まっていないジョブを取り消す。取り消せたら True"""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = 'canceled', progress = 'canceled', updated_at = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        return cursor.rowcount > 0
+
+    def pending_count(self):
+        """待機中・実行中のジョブ数"""
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+
+    def _claim(self):
+        """実行するジョブを1件取り出して実行中にする（なければ None）"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 再実行の上限に達した放置ジョブは失敗扱いにする
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? "
+                "WHERE status = 'running' AND updated_at < ? AND attempts >= ?",
+                ("処理中にワーカーが停止しました", now, now - self.stale_after, self.max_attempts)
+            )
+            row = conn.execute(
+                "SELECT id, payload FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND updated_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now - self.stale_after,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', progress = 'started', owner = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (self.owner, now, row[0])
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id)
+        )
+
+    def _purge(self):
+        """完了から時間が経ったジョブを削除する"""
+        self._connect().execute(
+            f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) AND updated_at < ?",
+            (*FINISHED_STATUSES, time.time() - self.keep_seconds)
+        )
+
+    def _work(self):
+        last_purge = 0
+        while True:
+            # データベースのエラー（ロック中など）でワーカーのスレッドが止まらないようにする
+            try:
+                last_purge = self._work_once(last_purge)
+            except Exception as e:
+                print(f"ジョブの処理中にエラーが発生しました: {str(e)}")
+                time.sleep(self.poll_interval)
+
+    def _work_once(self, last_purge):
+        """ジョブを1件実行する（なければ待つ）。最後に古いジョブを削除した時刻を返す"""
+        try:
+            job = self._claim()
+        except sqlite3.Error as e:
+            print(f"ジョブの取得に失敗しました: {str(e)}")
+            job = None
+
+        if job is None:
+            if time.time() - last_purge > 60 * 60:
+                self._purge()
+                last_purge = time.time()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            return last_purge
+
+        job_id, payload = job
+
+        def report(progress, result=None):
+            # 進捗の更新は実行中であることの通知も兼ねる。result を渡すと途中の結果として公開する
+            if result is None:
+                self._update(job_id, progress=progress)
+            else:
+                self._update(job_id, progress=progress, result=json.dumps(result, ensure_ascii=False))
+
+        try:
+            result = self.handler(json.loads(payload), report)
+        except Exception as e:
+            self._finish(job_id, status='failed', progress='failed', error=str(e))
+        else:
+            self._finish(
+                job_id,
+                status='done',
+                progress='done',
+                result=json.dumps(result, ensure_ascii=False)
+            )
+        return last_purge
+
+    def _finish(self, job_id, **fields):
+        """ジョブの結果を書き込む（書き込めなければ失敗として記録し直す）"""
+        try:
+            self._update(job_id, **fields)
+        except Exception as e:
+            print(f"ジョブの状態の更新に失敗しました ({job_id}): {str(e)}")
+            # 実行中のまま残らないよう、失敗として記録する（これも失敗した場合は、放置ジョブとして再実行される）
+            self._update(job_id, status='failed', progress='failed', error=f"ジョブの状態の更新に失敗しました: {str(e)}")
@@ -0,0 +1,171 @@
+import mimetypes
+import os
+import shutil
+
+from utils.audio_transcoder import AUDIO_FORMATS
+from utils.capture_ids import atomic_target, atomic_write
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 がない環境ではローカルのファイルシステムのみ使える
+    boto3 = None
+
+# 保存するファイルは内容ハッシュで名前が決まり中身が変わらないため、長期間キャッシュさせる
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def content_type(key):
+    """キーの拡張子から Content-Type を返す"""
+    ext = os.path.splitext(key)[1].lstrip('.').lower()
+    for extension, mimetype in AUDIO_FORMATS.values():
+        if extension == ext:
+            return mimetype
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+class LocalBackend:
+    """メディアをローカルのファイルシステムに保存する（root 以下を base_url で配信する）"""
+
+    is_local = True
+
+    def __init__(self, root, base_url):
+        # 作業ディレクトリが後で変わっても同じ場所を指すよう、絶対パスにしておく
+        self.root = os.path.abspath(root)
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put_file(self, key, src_path, move=False):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if move:
+            os.replace(src_path, path)
+        else:
+            with atomic_target(path) as tmp_path:
+                shutil.copyfile(src_path, tmp_path)
+
+    def put_bytes(self, key, content):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, content)
+
+    def download(self, key, dst_path):
+        shutil.copyfile(self.path(key), dst_path)
+
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+class S3Backend:
+    """メディアを S3 互換のオブジェクトストレージに保存する
+
+    複数のサーバーで同じメディアを共有できる。配信用のURLは期限付きの署名付きURL
+    （public_base_url を指定した場合は CDN などの公開URL）。
+    大きなファイルは multipart_threshold を超えるとマルチパートで分割アップロードする。
+    MinIO などのローカルの S3 互換サーバーで試す場合は endpoint_url を指定する:
+
+        docker run -p 9000:9000 minio/minio server /data      # または moto_server -p 9000
+        MEDIA_BACKEND=s3 S3_BUCKET=scanjourney S3_ENDPOINT_URL=http://localhost:9000 \\
+        AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=minioadmin python app.py
+    """
+
+    is_local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, presign_expires=3600,
+                 public_base_url=None, multipart_threshold=8 * 1024 * 1024, client=None, create_bucket=False):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("S3 に保存するには boto3 が必要です")
+            client = boto3.client(
+                's3',
+                endpoint_url=endpoint_url,
+                region_name=region,
+                config=Config(signature_version='s3v4', retries={'max_attempts': 5, 'mode': 'standard'})
+            )
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.presign_expires = presign_expires
+        self.public_base_url = public_base_url.rstrip('/') if public_base_url else None
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold
+        )
+        if create_bucket:
+            self._ensure_bucket()
+
+    def _ensure_bucket(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError:
+            self.client.create_bucket(Bucket=self.bucket)
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def _extra_args(self, key):
+        return {'ContentType': content_type(key), 'CacheControl': IMMUTABLE_CACHE_CONTROL}
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put_file(self, key, src_path, move=False):
+        # ファイルから読みながら送るため、大きなファイルでもメモリに載せない
+        self.client.upload_file(
+            src_path, self.bucket, self._object_key(key),
+            ExtraArgs=self._extra_args(key), Config=self.transfer_config
+        )
+        if move:
+            os.remove(src_path)
+
+    def put_bytes(self, key, content):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=content, **self._extra_args(key))
+
+    def download(self, key, dst_path):
+        self.client.download_file(self.bucket, self._object_key(key), dst_path, Config=self.transfer_config)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def url(self, key):
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self._object_key(key)}"
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self._object_key(key)},
+            ExpiresIn=self.presign_expires
+        )
+
+def create_media_backend(root, base_url):
+    """環境変数の設定に従ってメディアの保存先を作る（MEDIA_BACKEND=s3 で S3 互換ストレージ）"""
+    name = os.environ.get('MEDIA_BACKEND', 'local')
+    if name == 'local':
+        return LocalBackend(root, base_url)
+    if name == 's3':
+        return S3Backend(
+            os.environ['S3_BUCKET'],
+            prefix=os.environ.get('S3_PREFIX', ''),
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL'),
+            region=os.environ.get('S3_REGION'),
+            presign_expires=int(os.environ.get('S3_PRESIGN_EXPIRES', 3600)),
+            public_base_url=os.environ.get('S3_PUBLIC_BASE_URL'),
+            multipart_threshold=int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', 8)) * 1024 * 1024,
+            create_bucket=os.environ.get('S3_CREATE_BUCKET', '0') == '1'
+        )
+    raise ValueError(f"不明なメディアの保存先です: {name}")
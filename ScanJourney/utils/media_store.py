@@ -0,0 +1,305 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.capture_ids import new_capture_id
+from utils.media_backends import LocalBackend
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# <ハッシュの先頭2桁>/<次の2桁>/<ハッシュ>.<拡張子>
+KEY_PATTERN = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})\.[a-z0-9]+$')
+
+def file_sha256(path):
+    """ファイルの内容の SHA-256（16進数）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_extension(path):
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+class MediaStore:
+    """撮影の画像・音声を内容ハッシュ(SHA-256)をキーにして保存する
+
+    キーは <ハッシュの先頭2桁>/<次の2桁>/<ハッシュ>.<拡張子> で、ローカルに保存する場合も
+    10万件を超えて1つのディレクトリのファイル数が増えすぎないようにする。
+    同じ内容のファイルは1つだけ保存し、保存済みのキーは SQLite の索引で管理する（ディレクトリは走査しない）。
+    バイト列の保存先は backend（LocalBackend / S3Backend）に任せる。
+    メタデータには保存先によらず url_prefix/subdir/<キー> の形の参照を保存し、
+    配信するときに public_url で保存先のURL（ローカルなら /media の配信用ルート、S3 なら署名付きURL）に変換する。
+    分析待ちの画像など、内容が確定する前のファイルはローカルの incoming に置く。
+    """
+
+    def __init__(self, upload_folder, backend=None, url_prefix='/static/uploads', subdir='media', timeout=30.0):
+        self.upload_folder = upload_folder
+        self.url_prefix = url_prefix
+        self.subdir = subdir
+        self.backend = backend or LocalBackend(os.path.join(upload_folder, subdir), f"{url_prefix}/{subdir}")
+        self.incoming_folder = os.path.join(upload_folder, 'incoming')
+        self.db_file = os.path.join(upload_folder, 'media.db')
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._metrics = {'stored': 0, 'deduplicated': 0, 'bytes_saved': 0}
+
+        os.makedirs(self.incoming_folder, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        """スレッドごとに接続を使い回す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    # --- キー・パス・URL ---
+
+    def key_for(self, digest, extension):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}.{extension}"
+
+    def digest_from_key(self, key):
+        """キーに含まれる内容ハッシュを返す（ストアのキーの形でなければ None）"""
+        match = KEY_PATTERN.match(key or '')
+        return match.group(3) if match else None
+
+    def url(self, key):
+        """メタデータに保存する参照"""
+        return f"{self.url_prefix}/{self.subdir}/{key}"
+
+    def key_from_url(self, url):
+        """ストアの参照ならキーを、それ以外（フラットに置かれた以前のファイルなど）なら None を返す"""
+        prefix = f"{self.url_prefix}/{self.subdir}/"
+        if url and url.startswith(prefix):
+            return url[len(prefix):]
+        return None
+
+    def public_url(self, url):
+        """参照を配信用のURLに変換する（ストア以外のURLはそのまま返す）"""
+        key = self.key_from_url(url)
+        return self.backend.url(key) if key else url
+
+    def local_path(self, url):
+        """アップロードフォルダ内のファイルのURLを、ファイルのパスに変換する（範囲外なら None）"""
+        prefix = f"{self.url_prefix}/"
+        if not url or not url.startswith(prefix):
+            return None
+        parts = url[len(prefix):].split('/')
+        if any(part in ('', '.', '..') for part in parts):
+            return None
+        return os.path.join(self.upload_folder, *parts)
+
+    @contextmanager
+    def local_file(self, url):
+        """参照先のファイルをローカルのパスとして使う（リモートの保存先なら一時的にダウンロードする）
+
+        ファイルがなければ None を渡す。
+        """
+        key = self.key_from_url(url)
+        if key is None or self.backend.is_local:
+            path = self.backend.path(key) if key else self.local_path(url)
+            yield path if path and os.path.isfile(path) else None
+            return
+
+        tmp_path = self.incoming_path(f"download_{new_capture_id()}_{os.path.basename(key)}")
+        try:
+            self.backend.download(key, tmp_path)
+        except Exception as e:
+            print(f"メディアのダウンロードに失敗しました ({key}): {str(e)}")
+            yield None
+            return
+        try:
+            yield tmp_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def incoming_path(self, filename):
+        """内容が確定する前のファイルを置くパス"""
+        return os.path.join(self.incoming_folder, filename)
+
+    # --- 保存・削除 ---
+
+    def contains(self, key):
+        """保存済みかどうか（索引になければ保存先に問い合わせ、あれば索引に加える）"""
+        row = self._connect().execute("SELECT size FROM objects WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            # ローカルなら実際にファイルがあるかも確かめる（確認の負荷が小さいため）
+            return not self.backend.is_local or self.backend.exists(key)
+        if self.backend.is_local or not self.backend.exists(key):
+            return False
+        # 他のサーバーが保存したもの
+        self._connect().execute(
+            "INSERT OR IGNORE INTO objects (key, size, created_at) VALUES (?, 0, ?)", (key, time.time())
+        )
+        return True
+
+    def _index(self, key, size):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO objects (key, size, created_at) VALUES (?, ?, ?)",
+            (key, size, time.time())
+        )
+        with self._lock:
+            self._metrics['stored'] += 1
+
+    def _deduplicated(self, size):
+        with self._lock:
+            self._metrics['deduplicated'] += 1
+            self._metrics['bytes_saved'] += size
+
+    def put_file(self, src_path, extension=None, move=True, digest=None):
+        """ファイルを保存して参照を返す（move=True なら src_path は保存後に残さない）
+
+        digest を指定すると、ファイルの内容ハッシュの代わりにそれをキーにする
+        （サムネイルのように元のファイルから決まる派生ファイルを、作る前に探せるようにするため）。
+        """
+        extension = extension or file_extension(src_path)
+        key = self.key_for(digest or file_sha256(src_path), extension)
+        size = os.path.getsize(src_path)
+
+        if self.contains(key):
+            if move:
+                os.remove(src_path)
+            self._deduplicated(size)
+            return self.url(key)
+
+        self.backend.put_file(key, src_path, move=move)
+        self._index(key, size)
+        return self.url(key)
+
+    def put_bytes(self, content, extension):
+        """バイト列を保存して参照を返す（同じ内容が保存済みなら書き込まない）"""
+        key = self.key_for(hashlib.sha256(content).hexdigest(), extension)
+        if self.contains(key):
+            self._deduplicated(len(content))
+            return self.url(key)
+
+        self.backend.put_bytes(key, content)
+        self._index(key, len(content))
+        return self.url(key)
+
+    def delete(self, url):
+        """参照先のファイルを削除する（同じ内容を参照している撮影がないことは呼び出し側で確認する）"""
+        key = self.key_from_url(url)
+        if key:
+            self._connect().execute("DELETE FROM objects WHERE key = ?", (key,))
+            self.backend.delete(key)
+            return
+        path = self.local_path(url)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def stats(self):
+        """このサーバーの索引にある件数・容量と、起動後の保存・重複の件数"""
+        count, total_bytes = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects"
+        ).fetchone()
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['backend'] = 'local' if self.backend.is_local else 's3'
+        metrics['objects'] = count
+        metrics['bytes'] = total_bytes
+        return metrics
+
+def migrate_flat_uploads(metadata_manager, media_store):
+    """以前の撮影の画像・音声・サムネイルをストアへ移す
+
+    アップロードフォルダ直下（やサムネイル用のディレクトリ）に置かれたファイルを移し、メタデータの参照を書き換える。
+    保存先をリモートに切り替えた場合は、ローカルに保存済みのファイルもアップロードする。
+
+    元のファイルは、全ての撮影のメタデータから参照されなくなったことを確認してから削除する
+    （移行中に他の更新でメタデータが書き戻された場合は残し、次回の移行でやり直す）。
+    移した撮影の数を返す（他プロセスが実行中なら何もしない）。
+    """
+    lock = open(os.path.join(media_store.upload_folder, '.media_migration.lock'), 'a')
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+        return _migrate_flat_uploads(metadata_manager, media_store)
+    finally:
+        lock.close()
+
+def _migrate_file(media_store, url, old_files, name=None):
+    """1つのファイルをストアへ移し、新しい参照を返す（移す必要がなければ None）"""
+    path = media_store.local_path(url)
+    if not path or not os.path.isfile(path):
+        return None
+    key = media_store.key_from_url(url)
+    if key:
+        # ローカルに保存済みのものは、保存先をリモートに切り替えた場合だけアップロードする（参照は変わらない）
+        if not media_store.backend.is_local:
+            if not media_store.backend.exists(key):
+                media_store.backend.put_file(key, path)
+            os.remove(path)
+        return None
+    old_files[name or url] = path
+    return media_store.put_file(path, move=False)
+
+def _migrate_flat_uploads(metadata_manager, media_store):
+    old_files = {}  # 以前のURL・サムネイル名 -> ファイルのパス
+    migrated = 0
+    for image_id, image_data in metadata_manager.get_images_by_timestamp():
+        updates = {}
+        for field in ('image_path', 'audio_path'):
+            new_url = _migrate_file(media_store, image_data.get(field), old_files)
+            if new_url:
+                updates[field] = new_url
+        # 文ごとの音声は最初からストアに保存している（リモートへのアップロードだけ必要）
+        for url in image_data.get('audio_chunks') or ():
+            _migrate_file(media_store, url, old_files)
+
+        thumbnails = []
+        for entry in image_data.get('thumbnails') or ():
+            entry = dict(entry)
+            for fmt in ('jpeg', 'webp'):
+                name = entry.get(fmt)
+                # 以前のサムネイルはアップロードフォルダからの相対パスで保存している
+                if name and not name.startswith('/'):
+                    new_url = _migrate_file(media_store, f"{media_store.url_prefix}/{name}", old_files, name)
+                    if new_url:
+                        entry[fmt] = new_url
+                        updates['thumbnails'] = thumbnails
+            thumbnails.append(entry)
+
+        if updates:
+            metadata_manager.update_image_data(image_id, dict(image_data, **updates))
+            migrated += 1
+
+    if old_files:
+        referenced = set()
+        for _, image_data in metadata_manager.get_images_by_timestamp():
+            referenced.add(image_data.get('image_path'))
+            referenced.add(image_data.get('audio_path'))
+            referenced.update(image_data.get('audio_chunks') or ())
+            for entry in image_data.get('thumbnails') or ():
+                referenced.add(entry.get('jpeg'))
+                referenced.add(entry.get('webp'))
+        for name, path in old_files.items():
+            if name not in referenced and os.path.exists(path):
+                os.remove(path)
+    return migrated
@@ -1,52 +1,409 @@
+import bisect
 import json
+import math
 import os
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from utils.capture_ids import new_capture_id
 
-class MetadataManager:
-    def __init__(self, metadata_file):
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなしで動作させる
+    fcntl = None
+
+# 位置検索用グリッドの1マスの大きさ（度）。0.01度は約1.1km
+GEO_CELL_DEGREES = 0.01
+
+def geo_cell(latitude, longitude):
+    """緯度・経度が属するグリッドのマス"""
+    return (math.floor(latitude / GEO_CELL_DEGREES), math.floor(longitude / GEO_CELL_DEGREES))
+
+def _coordinates(image_data):
+    """画像データの (緯度, 経度)。なければ None"""
+    try:
+        return float(image_data['latitude']), float(image_data['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class JsonMetadataStore:
+    """メタデータをメモリ上に保持し、変更を追記ジャーナルへ書き込むJSONバックエンド
+
+    metadata.json はスナップショット、metadata.json.journal は
+    スナップショット以降に追加されたレコードを1行1件で追記したもの。
+    ジャーナルが一定件数を超えたらスナップショットへ統合（アトミックに置き換え）する。
+    """
+
+    def __init__(self, metadata_file, compact_every=100):
         self.metadata_file = metadata_file
+        self.journal_file = f"{metadata_file}.journal"
+        self.lock_file = f"{metadata_file}.lock"
+        self.compact_every = compact_every
+
+        self._lock = threading.RLock()
+        self._file_lock_depth = 0
+        self._metadata = {}
+        self._by_filename = {}
+        self._by_timestamp = []
+        self._by_cell = {}
+        self._snapshot_stat = None
+        self._journal_stat = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+
         self.ensure_metadata_file()
+        with self._lock:
+            self._reload()
 
     def ensure_metadata_file(self):
         """メタデータファイルが存在しない場合は作成"""
         if not os.path.exists(self.metadata_file):
             os.makedirs(os.path.dirname(self.metadata_file), exist_ok=True)
-            self.save_metadata({})
+            self._write_snapshot({})
 
-    def load_metadata(self):
-        """メタデータの読み込み"""
+    # --- ファイル操作 ---
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        """プロセス間でメタデータファイルへのアクセスを排他制御する"""
+        # 既にロックを保持している場合（書き込み中の再読み込みなど）は取り直さない
+        if fcntl is None or self._file_lock_depth:
+            self._file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth -= 1
+            return
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth -= 1
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _stat(self, path):
+        """変更検知用に (inode, mtime, size) を取得する"""
         try:
-            with open(self.metadata_file, 'r') as f:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _write_snapshot(self, metadata):
+        """一時ファイルに書き出してからリネームし、スナップショットを置き換える"""
+        tmp_file = f"{self.metadata_file}.tmp.{os.getpid()}"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.metadata_file)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.metadata_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        except:
+        except (OSError, ValueError):
             return {}
 
+    def _read_journal(self, offset):
+        """offset 以降のジャーナルを読み、(レコード一覧, 読み終えた位置) を返す"""
+        try:
+            with open(self.journal_file, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return [], 0
+
+        # 書き込み途中の行は次回に回す
+        end = chunk.rfind(b'\n') + 1
+        records = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                continue
+        return records, offset + end
+
+    # --- インデックス ---
+
+    def _index(self, image_id, image_data):
+        """インデックスへ1件登録する（既存IDは置き換え）"""
+        if image_id in self._metadata:
+            self._unindex(image_id)
+        self._metadata[image_id] = image_data
+
+        filename = os.path.basename(image_data.get('image_path', ''))
+        if filename:
+            self._by_filename[filename] = image_id
+        bisect.insort(self._by_timestamp, (image_data.get('timestamp', ''), image_id))
+        coordinates = _coordinates(image_data)
+        if coordinates:
+            self._by_cell.setdefault(geo_cell(*coordinates), set()).add(image_id)
+
+    def _unindex(self, image_id):
+        image_data = self._metadata.pop(image_id)
+        filename = os.path.basename(image_data.get('image_path', ''))
+        if self._by_filename.get(filename) == image_id:
+            del self._by_filename[filename]
+        key = (image_data.get('timestamp', ''), image_id)
+        i = bisect.bisect_left(self._by_timestamp, key)
+        if i < len(self._by_timestamp) and self._by_timestamp[i] == key:
+            del self._by_timestamp[i]
+        coordinates = _coordinates(image_data)
+        if coordinates:
+            self._by_cell.get(geo_cell(*coordinates), set()).discard(image_id)
+
+    def _apply_journal(self, records):
+        for record in records:
+            if isinstance(record, dict) and 'id' in record and isinstance(record.get('data'), dict):
+                self._index(record['id'], record['data'])
+                self._journal_entries += 1
+
+    def _reload(self):
+        """スナップショットとジャーナルを読み直してインデックスを再構築する"""
+        with self._file_lock(exclusive=False):
+            snapshot_stat = self._stat(self.metadata_file)
+            metadata = self._read_snapshot()
+            records, offset = self._read_journal(0)
+            journal_stat = self._stat(self.journal_file)
+
+        self._metadata = {}
+        self._by_filename = {}
+        self._by_timestamp = []
+        self._by_cell = {}
+        self._journal_entries = 0
+        for image_id, image_data in metadata.items():
+            self._index(image_id, image_data)
+        self._apply_journal(records)
+
+        self._snapshot_stat = snapshot_stat
+        self._journal_stat = journal_stat
+        self._journal_offset = offset
+
+    def _refresh_if_changed(self):
+        """他プロセスによるファイル変更を検知し、必要な分だけ読み直す"""
+        if self._stat(self.metadata_file) != self._snapshot_stat:
+            self._reload()
+            return
+
+        journal_stat = self._stat(self.journal_file)
+        if journal_stat == self._journal_stat:
+            return
+        if journal_stat is None or self._journal_stat is None \
+                or journal_stat[0] != self._journal_stat[0] or journal_stat[2] < self._journal_offset:
+            # ジャーナルが置き換えられた・切り詰められた場合は全体を読み直す
+            self._reload()
+            return
+
+        # 追記された分だけ反映する
+        with self._file_lock(exclusive=False):
+            records, offset = self._read_journal(self._journal_offset)
+        self._apply_journal(records)
+        self._journal_offset = offset
+        self._journal_stat = journal_stat
+
+    def _compact(self):
+        """ジャーナルをスナップショットへ統合する（ロック取得済みで呼ぶ）"""
+        self._write_snapshot(self._metadata)
+        # 新しい空ファイルに置き換え、他プロセスにも inode の変化で伝える
+        tmp_file = f"{self.journal_file}.tmp.{os.getpid()}"
+        open(tmp_file, 'wb').close()
+        os.replace(tmp_file, self.journal_file)
+
+        self._snapshot_stat = self._stat(self.metadata_file)
+        self._journal_stat = self._stat(self.journal_file)
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    # --- ストレージAPI ---
+
+    def load_all(self):
+        """全件を {画像ID: 画像データ} で取得"""
+        with self._lock:
+            self._refresh_if_changed()
+            return dict(self._metadata)
+
+    def replace_all(self, metadata):
+        """全件を置き換える"""
+        with self._lock, self._file_lock(exclusive=True):
+            self._metadata = {}
+            self._by_filename = {}
+            self._by_timestamp = []
+            self._by_cell = {}
+            for image_id, image_data in metadata.items():
+                self._index(image_id, image_data)
+            self._compact()
+
+    def put(self, image_id, image_data):
+        """1件を追加（既存IDは上書き）"""
+        line = json.dumps({'id': image_id, 'data': image_data}, ensure_ascii=False) + '\n'
+
+        with self._lock, self._file_lock(exclusive=True):
+            # 他プロセスの追記を取り込んでから書き込む
+            self._refresh_if_changed()
+            with open(self.journal_file, 'ab') as f:
+                f.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._index(image_id, image_data)
+            self._journal_entries += 1
+            self._journal_offset += len(line.encode('utf-8'))
+            self._journal_stat = self._stat(self.journal_file)
+
+            if self._journal_entries >= self.compact_every:
+                self._compact()
+
+    def get(self, image_id):
+        with self._lock:
+            self._refresh_if_changed()
+            return self._metadata.get(image_id)
+
+    def get_by_filename(self, filename):
+        with self._lock:
+            self._refresh_if_changed()
+            image_id = self._by_filename.get(os.path.basename(filename))
+            return self._metadata.get(image_id) if image_id else None
+
+    def list_by_timestamp(self, reverse=True):
+        """撮影日時順に (画像ID, 画像データ) のリストを取得"""
+        with self._lock:
+            self._refresh_if_changed()
+            ordered = reversed(self._by_timestamp) if reverse else iter(self._by_timestamp)
+            return [(image_id, self._metadata[image_id]) for _, image_id in ordered]
+
+    def list_page(self, limit, cursor=None):
+        """新しい順に、cursor=(タイムスタンプ, 画像ID) より前の limit 件を取得"""
+        with self._lock:
+            self._refresh_if_changed()
+            end = bisect.bisect_left(self._by_timestamp, cursor) if cursor else len(self._by_timestamp)
+            keys = self._by_timestamp[max(0, end - limit):end]
+            return [(image_id, self._metadata[image_id]) for _, image_id in reversed(keys)]
+
+    def list_near(self, min_lat, max_lat, min_lng, max_lng):
+        """緯度・経度の範囲内にある (画像ID, 画像データ) のリストを取得"""
+        with self._lock:
+            self._refresh_if_changed()
+            min_cell = geo_cell(min_lat, min_lng)
+            max_cell = geo_cell(max_lat, max_lng)
+            results = []
+            for lat_cell in range(min_cell[0], max_cell[0] + 1):
+                for lng_cell in range(min_cell[1], max_cell[1] + 1):
+                    for image_id in self._by_cell.get((lat_cell, lng_cell), ()):
+                        image_data = self._metadata[image_id]
+                        latitude, longitude = _coordinates(image_data)
+                        if min_lat <= latitude <= max_lat and min_lng <= longitude <= max_lng:
+                            results.append((image_id, image_data))
+            return results
+
+    def list_by_audio_path(self, audio_path):
+        """指定の音声ファイルを参照している (画像ID, 画像データ) のリストを取得（文ごとの音声も含む）"""
+        with self._lock:
+            self._refresh_if_changed()
+            return [
+                (image_id, image_data) for image_id, image_data in self._metadata.items()
+                if image_data.get('audio_path') == audio_path or audio_path in (image_data.get('audio_chunks') or ())
+            ]
+
+    def version(self):
+        """内容が変わると値が変わるトークン（キャッシュの無効化判定用）"""
+        with self._lock:
+            self._refresh_if_changed()
+            return (self._snapshot_stat, self._journal_stat)
+
+
+class MetadataManager:
+    """画像メタデータの読み書きを行う（保存先はストレージバックエンドに委譲）"""
+
+    def __init__(self, metadata_file, store=None):
+        self.metadata_file = metadata_file
+        self.store = store if store is not None else JsonMetadataStore(metadata_file)
+
+        # アルバム表示用のページキャッシュ（保存のたびに無効化）
+        self._album_lock = threading.Lock()
+        self._album_cache = {}
+        self._album_version = None
+
+    def _invalidate_album_cache(self):
+        with self._album_lock:
+            self._album_cache = {}
+            self._album_version = None
+
+    def load_metadata(self):
+        """メタデータの読み込み"""
+        return self.store.load_all()
+
     def save_metadata(self, metadata):
         """メタデータの保存"""
-        with open(self.metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
-
-    def save_image_data(self, image_data):
-        """画像データの保存"""
-        metadata = self.load_metadata()
-        image_id = datetime.now().strftime('%Y%m%d_%H%M%S')
-        metadata[image_id] = image_data
-        self.save_metadata(metadata)
+        self.store.replace_all(metadata)
+        self._invalidate_album_cache()
+
+    def save_image_data(self, image_data, image_id=None):
+        """画像データを保存し、画像IDを返す（省略時は新しい撮影IDを作る）"""
+        image_id = image_id or new_capture_id()
+        self.store.put(image_id, image_data)
+        self._invalidate_album_cache()
         return image_id
 
+    def update_image_data(self, image_id, image_data):
+        """既存の画像データの更新"""
+        self.store.put(image_id, image_data)
+        self._invalidate_album_cache()
+
     def get_image_data(self, image_id):
         """画像データの取得"""
-        metadata = self.load_metadata()
-        return metadata.get(image_id)
+        return self.store.get(image_id)
 
     def get_all_images(self):
         """全画像データの取得"""
-        return self.load_metadata()
+        return self.store.load_all()
 
     def get_image_data_by_filename(self, filename):
         """ファイル名から画像データを取得"""
-        metadata = self.load_metadata()
-        for image_id, data in metadata.items():
-            if data.get('image_path', '').endswith(filename):
-                return data
-        return None
\ No newline at end of file
+        return self.store.get_by_filename(filename)
+
+    def get_images_by_timestamp(self, reverse=True):
+        """撮影日時順に (画像ID, 画像データ) のリストを取得"""
+        return self.store.list_by_timestamp(reverse)
+
+    def get_images_near(self, min_lat, max_lat, min_lng, max_lng):
+        """緯度・経度の範囲内で撮影された (画像ID, 画像データ) のリストを取得"""
+        return self.store.list_near(min_lat, max_lat, min_lng, max_lng)
+
+    def get_images_by_audio_path(self, audio_path):
+        """指定の音声ファイルを参照している (画像ID, 画像データ) のリストを取得"""
+        return self.store.list_by_audio_path(audio_path)
+
+    def get_album_page(self, limit=30, cursor=None):
+        """アルバム1ページ分の (画像IDと画像データのリスト, 次ページのカーソル) を取得
+
+        カーソルは前ページ最後の画像の「タイムスタンプ|画像ID」。
+        結果はキャッシュし、他プロセスを含めて新しい保存があった時だけ作り直す。
+        """
+        version = self.store.version()
+        key = (cursor, limit)
+        with self._album_lock:
+            if self._album_version != version:
+                self._album_cache = {}
+                self._album_version = version
+            page = self._album_cache.get(key)
+        if page is not None:
+            return page
+
+        decoded = tuple(cursor.rsplit('|', 1)) if cursor and '|' in cursor else None
+        # 次ページの有無を判定するため1件多く取得する
+        items = self.store.list_page(limit + 1, decoded)
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last_id, last_data = items[-1]
+            next_cursor = f"{last_data.get('timestamp', '')}|{last_id}"
+
+        page = (items, next_cursor)
+        with self._album_lock:
+            if self._album_version == version:
+                self._album_cache[key] = page
+        return page
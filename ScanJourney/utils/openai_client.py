@@ -0,0 +1,422 @@
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from utils.context_manager import message_tokens
+
+try:
+    import httpx
+    import openai
+except ImportError:  # openai がない環境では偽のプロバイダーだけ使える
+    httpx = None
+    openai = None
+
+# 処理ごとのタイムアウト（秒）。環境変数 OPENAI_TIMEOUT_<処理名の大文字> で変更できる
+DEFAULT_TIMEOUTS = {
+    'analysis': 60.0,
+    'description': 60.0,
+    'place': 20.0,
+    'chat': 60.0,
+    'summary': 30.0,
+    'tts': 30.0
+}
+CONNECT_TIMEOUT = 10.0
+# max_tokens を指定しないリクエストの応答の見積もり
+DEFAULT_COMPLETION_TOKENS = 1000
+
+def timeouts_from_env(defaults=DEFAULT_TIMEOUTS):
+    """環境変数で上書きした処理ごとのタイムアウトを返す"""
+    return {task: float(os.environ.get(f"OPENAI_TIMEOUT_{task.upper()}", timeout)) for task, timeout in defaults.items()}
+
+class ProviderBusyError(Exception):
+    """上限に達していて待ち時間が長すぎるため、リクエストを送らずに断った"""
+
+    def __init__(self, retry_after):
+        # やり直すまでの秒数（Retry-After ヘッダーに使うので1以上の整数にする）
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"リクエストが混み合っています。{self.retry_after}秒ほど待ってからやり直してください")
+
+class TokenBucket:
+    """1分あたり per_minute の量を補充するトークンバケット
+
+    OpenAI は1分より短い単位でも上限を確かめるため、貯められるのは burst_seconds 秒ぶんまでにする。
+    """
+
+    def __init__(self, per_minute, burst_seconds=10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """amount を使えるまでの秒数（1回で容量を超える量は容量ぶんとして扱う）"""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        # 足りないぶんはマイナスにして、後から来たリクエストを待たせる
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+class RateLimiter:
+    """OpenAI へのリクエストを組織の上限（RPM / TPM）と同時実行数に収める
+
+    上限はモデルごとにかかるため、バケットもモデルごとに持つ（0 なら制限しない）。
+    reserve は先にバケットから差し引いて待つべき秒数を返すだけなので、
+    スレッドからも非同期の処理からも同じバケットを使える。
+    同時実行数はスレッド（Flask）と非同期（ASGI のチャット）を合わせて max_concurrency までにする。
+    待ち時間が max_wait 秒を超える場合は待たずに ProviderBusyError にする。
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=0, max_wait=30.0, burst_seconds=10.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.burst_seconds = burst_seconds
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # スレッドからも非同期の処理からも同じ枠を使う
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._metrics = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'rejected': 0}
+
+    def _model_buckets(self, model):
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            buckets = (
+                TokenBucket(self.rpm, self.burst_seconds) if self.rpm else None,
+                TokenBucket(self.tpm, self.burst_seconds) if self.tpm else None
+            )
+            self._buckets[model] = buckets
+        return buckets
+
+    def reserve(self, model, tokens):
+        """リクエスト1回ぶんを差し引き、送ってよいまでの秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            request_bucket, token_bucket = self._model_buckets(model)
+            needs = [(bucket, amount) for bucket, amount in ((request_bucket, 1), (token_bucket, tokens)) if bucket]
+            wait = 0.0
+            for bucket, amount in needs:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount))
+            if wait > self.max_wait:
+                self._metrics['rejected'] += 1
+                raise ProviderBusyError(wait)
+            for bucket, amount in needs:
+                bucket.take(amount)
+            self._metrics['requests'] += 1
+            if wait:
+                self._metrics['throttled'] += 1
+                self._metrics['wait_seconds'] += wait
+        return wait
+
+    def settle(self, model, estimated, actual):
+        """見積もりより使ったトークンが少なければ、差をバケットに戻す（多ければさらに差し引く）"""
+        with self._lock:
+            token_bucket = self._model_buckets(model)[1]
+            if token_bucket is None:
+                return
+            token_bucket.refill(time.monotonic())
+            if actual < estimated:
+                token_bucket.give_back(estimated - actual)
+            else:
+                token_bucket.take(actual - estimated)
+
+    def _busy(self):
+        with self._lock:
+            self._metrics['rejected'] += 1
+        return ProviderBusyError(self.max_wait)
+
+    def acquire(self):
+        """同時実行数の枠を1つ取る（max_wait 秒待っても空かなければ ProviderBusyError）"""
+        if self._semaphore is not None and not self._semaphore.acquire(timeout=self.max_wait):
+            raise self._busy()
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    async def acquire_async(self):
+        """acquire の非同期版（枠が空くのを待つ間もイベントループを止めない）"""
+        if self._semaphore is None or self._semaphore.acquire(blocking=False):
+            return
+        # 空くのを待つのはスレッドで行う（スレッドの処理と同じ枠を使うため asyncio.Semaphore は使わない）
+        future = asyncio.get_running_loop().run_in_executor(None, self._semaphore.acquire, True, self.max_wait)
+        try:
+            acquired = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 待っている間に取り消された場合、後から取れた枠はすぐに返す
+            future.add_done_callback(lambda f: f.result() and self._semaphore.release())
+            raise
+        if not acquired:
+            raise self._busy()
+
+    @contextmanager
+    def slot(self):
+        """同時に送るリクエストの数を max_concurrency までにする"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics.update(rpm=self.rpm, tpm=self.tpm, max_concurrency=self.max_concurrency)
+        return metrics
+
+def is_retryable(error):
+    """時間をおけば成功しうるエラーか（接続・タイムアウト・429・5xx）"""
+    if openai is None:
+        return False
+    if isinstance(error, openai.RateLimitError):
+        # 利用枠を使い切った場合は待っても回復しない
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    if isinstance(error, openai.APIConnectionError):  # APITimeoutError を含む
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def retry_after(error):
+    """レスポンスの Retry-After ヘッダーの秒数（なければ None）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+def request_tokens(messages, max_tokens=None):
+    """TPM の上限に数えるトークン数の見積もり（入力と、応答の最大トークン数）"""
+    return sum(message_tokens(m) for m in messages) + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+def tokens_used(response):
+    """レスポンスの usage の合計トークン数（なければ None）"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    return (getattr(usage, 'prompt_tokens', 0) or 0) + (getattr(usage, 'completion_tokens', 0) or 0)
+
+class RequestPolicy:
+    """処理ごとのタイムアウト・流量の制限・再試行をまとめて、OpenAI の呼び出しに適用する
+
+    429 や 5xx、接続エラーは指数バックオフ（ジッターあり）で max_retries 回まで再試行する。
+    Retry-After が返された場合はその秒数だけ待つ。再試行も1回のリクエストとして流量の制限に数える。
+    """
+
+    def __init__(self, limiter=None, timeouts=None, max_retries=3, backoff_base=0.5, backoff_max=20.0):
+        self.limiter = limiter or RateLimiter()
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._metrics = {'retries': 0, 'failures': 0}
+
+    def timeout(self, task):
+        return self.timeouts.get(task, DEFAULT_TIMEOUTS['chat'])
+
+    def backoff(self, attempt, error):
+        """attempt 回目の失敗の後に待つ秒数"""
+        seconds = retry_after(error)
+        if seconds is None:
+            # 同時に失敗したリクエストが同じタイミングで再試行しないよう、0〜上限の間でばらつかせる
+            seconds = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return min(seconds, self.backoff_max)
+
+    def _failed(self, attempt, error):
+        """再試行するなら待つ秒数を、しないなら None を返す"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            with self._lock:
+                self._metrics['failures'] += 1
+            return None
+        with self._lock:
+            self._metrics['retries'] += 1
+        return self.backoff(attempt, error)
+
+    def call(self, task, model, request, tokens=0, stream=False):
+        """request(timeout) を制限内で呼び出し、レスポンスを返す
+
+        stream=True のときは、ストリームを読み終わるか閉じるまで同時実行数の枠を持ち続ける。
+        """
+        attempt = 0
+        while True:
+            time.sleep(self.limiter.reserve(model, tokens))
+            self.limiter.acquire()
+            try:
+                response = request(self.timeout(task))
+            except Exception as e:
+                self.limiter.release()
+                wait = self._failed(attempt, e)
+                if wait is None:
+                    raise
+                attempt += 1
+                time.sleep(wait)
+                continue
+            if stream:
+                return self._held_stream(response, model, tokens)
+            self.limiter.release()
+            self._settle(model, tokens, response)
+            return response
+
+    async def call_async(self, task, model, request, tokens=0, stream=False):
+        """call の非同期版（request(timeout) はコルーチンを返す）"""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.limiter.reserve(model, tokens))
+            await self.limiter.acquire_async()
+            try:
+                response = await request(self.timeout(task))
+            except Exception as e:
+                self.limiter.release()
+                wait = self._failed(attempt, e)
+                if wait is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(wait)
+                continue
+            if stream:
+                return self._held_async_stream(response, model, tokens)
+            self.limiter.release()
+            self._settle(model, tokens, response)
+            return response
+
+    def _held_stream(self, stream, model, tokens):
+        """ストリームのチャンクをそのまま返し、終わったら枠を返して使ったトークン数で精算する"""
+        last = None
+        try:
+            for chunk in stream:
+                # usage は最後のチャンクにだけ入る（stream_options={'include_usage': True} のとき）
+                if getattr(chunk, 'usage', None) is not None:
+                    last = chunk
+                yield chunk
+        finally:
+            close = getattr(stream, 'close', None)
+            try:
+                if close is not None:
+                    close()
+            finally:
+                self.limiter.release()
+                self._settle(model, tokens, last)
+
+    async def _held_async_stream(self, stream, model, tokens):
+        last = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    last = chunk
+                yield chunk
+        finally:
+            close = getattr(stream, 'aclose', None) or getattr(stream, 'close', None)
+            try:
+                if close is not None:
+                    result = close()
+                    if asyncio.iscoroutine(result):
+                        await result
+            finally:
+                self.limiter.release()
+                self._settle(model, tokens, last)
+
+    def _settle(self, model, tokens, response):
+        used = tokens_used(response) if tokens and response is not None else None
+        if used is not None:
+            self.limiter.settle(model, tokens, used)
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics.update(self.limiter.stats())
+        return metrics
+
+def policy_from_env():
+    """環境変数の設定から RequestPolicy を作る
+
+    OPENAI_RPM / OPENAI_TPM はモデルごとの組織の上限（0 で制限しない）、
+    OPENAI_MAX_CONCURRENCY は同時に送るリクエストの数、OPENAI_MAX_QUEUE_WAIT は上限に達したときに待つ最長の秒数。
+    """
+    return RequestPolicy(
+        limiter=RateLimiter(
+            rpm=int(os.environ.get('OPENAI_RPM', 0)),
+            tpm=int(os.environ.get('OPENAI_TPM', 0)),
+            max_concurrency=int(os.environ.get('OPENAI_MAX_CONCURRENCY', 32)),
+            max_wait=float(os.environ.get('OPENAI_MAX_QUEUE_WAIT', 30))
+        ),
+        timeouts=timeouts_from_env(),
+        max_retries=int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+    )
+
+def _pool_limits():
+    return httpx.Limits(
+        max_connections=int(os.environ.get('OPENAI_MAX_CONNECTIONS', 200)),
+        max_keepalive_connections=int(os.environ.get('OPENAI_MAX_KEEPALIVE', 50)),
+        keepalive_expiry=float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 30))
+    )
+
+def _default_timeout():
+    return httpx.Timeout(DEFAULT_TIMEOUTS['chat'], connect=CONNECT_TIMEOUT)
+
+_shared_lock = threading.Lock()
+_shared = {}
+
+def _shared_instance(key, factory):
+    with _shared_lock:
+        if key not in _shared:
+            _shared[key] = factory()
+        return _shared[key]
+
+def shared_policy():
+    """プロセス内の全ての呼び出し元で共有する RequestPolicy（上限は組織全体にかかるため）"""
+    return _shared_instance('policy', policy_from_env)
+
+def shared_client(api_key=None):
+    """接続プールを共有する OpenAI クライアント（API キーごとに1つ）
+
+    再試行は RequestPolicy でするため、クライアント自身の再試行は無効にする。
+    """
+    if openai is None:
+        raise RuntimeError("OpenAI を使うには openai が必要です")
+    api_key = api_key or os.environ.get('OPENAI_API_KEY')
+    return _shared_instance(('sync', api_key), lambda: openai.OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        timeout=_default_timeout(),
+        http_client=httpx.Client(limits=_pool_limits(), timeout=_default_timeout())
+    ))
+
+def shared_async_client(api_key=None):
+    """shared_client の非同期版（AsyncOpenAI）"""
+    if openai is None:
+        raise RuntimeError("OpenAI を使うには openai が必要です")
+    api_key = api_key or os.environ.get('OPENAI_API_KEY')
+    return _shared_instance(('async', api_key), lambda: openai.AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        timeout=_default_timeout(),
+        http_client=httpx.AsyncClient(limits=_pool_limits(), timeout=_default_timeout())
+    ))
@@ -0,0 +1,108 @@
+import threading
+
+# プロンプトは「変わらない部分 → 場所ごとに変わる部分 → リクエストごとに変わる部分」の順に並べる。
+# 先頭が同じリクエストはAPI側でプロンプトキャッシュが効き、入力の処理時間と料金が下がる。
+
+GUIDE_SYSTEM_PROMPT = (
+    "あなたは観光地を案内するガイドです。"
+    "次のメッセージにある場所の名前と説明に基づいて、観光客の質問に日本語で答えてください。"
+    "ガイドが観光客に話しかけるような親しみやすい口調で、説明にないことは推測であると分かるように話してください。"
+)
+
+ANALYSIS_SYSTEM_PROMPT = (
+    "あなたは観光地を案内するガイドです。"
+    "観光客が撮影した写真と撮影地点の緯度・経度が与えられます。"
+    "緯度と経度は場所を特定するためだけに使い、回答には含めないでください。"
+)
+
+DESCRIPTION_INSTRUCTIONS = (
+    "画像の内容と撮影された場所について、名称を交えて詳しく説明してください。"
+    "歴史的背景や周辺の観光スポット、危険な場所、治安、注意点についても具体的に触れてください。"
+    "説明は日本語で、ガイドが観光客に説明するような親しみやすい口調でお願いします。"
+)
+
+PLACE_INSTRUCTIONS = "この場所の名前を、単語のみの形で答えてください。"
+
+STRUCTURED_INSTRUCTIONS = (
+    DESCRIPTION_INSTRUCTIONS
+    + "結果はJSONで返し、descriptionに説明を、placeにこの場所の名前を単語のみで入れてください。"
+)
+
+def guide_chat_messages(place_name, description):
+    """観光ガイドのチャットの先頭に置くメッセージ（共通の指示 → 場所の情報）"""
+    return [
+        {"role": "system", "content": GUIDE_SYSTEM_PROMPT},
+        {"role": "system", "content": f"場所：{place_name}\n説明：\n{description}"}
+    ]
+
+def analysis_messages(instructions, image_data, latitude, longitude):
+    """写真の分析リクエストのメッセージ（共通の指示 → 画像 → 撮影地点と依頼内容）
+
+    同じ画像に対する説明と名称のリクエストは、画像までが共通になる。
+    """
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{image_data}"
+                    }
+                },
+                {
+                    "type": "text",
+                    "text": f"撮影地点：緯度{latitude}、経度{longitude}\n{instructions}"
+                }
+            ]
+        }
+    ]
+
+# ストリーミングの最後のチャンクにトークン数を含めるためのオプション
+STREAM_USAGE_OPTIONS = {"stream_options": {"include_usage": True}}
+
+def _field(value, name):
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+class PromptUsageTracker:
+    """レスポンスのトークン数を呼び出し元ごとに集計し、プロンプトキャッシュの効き具合を確認する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = {}
+
+    def record(self, name, response):
+        """レスポンス（またはストリーミングの最後のチャンク）の usage を記録する"""
+        usage = _field(response, 'usage')
+        if usage is None:
+            return
+        prompt_tokens = _field(usage, 'prompt_tokens') or 0
+        cached_tokens = _field(_field(usage, 'prompt_tokens_details'), 'cached_tokens') or 0
+        completion_tokens = _field(usage, 'completion_tokens') or 0
+
+        with self._lock:
+            entry = self._usage.setdefault(name, {
+                'requests': 0,
+                'prompt_tokens': 0,
+                'cached_tokens': 0,
+                'completion_tokens': 0
+            })
+            entry['requests'] += 1
+            entry['prompt_tokens'] += prompt_tokens
+            entry['cached_tokens'] += cached_tokens
+            entry['completion_tokens'] += completion_tokens
+
+    def stats(self):
+        with self._lock:
+            usage = {name: dict(entry) for name, entry in self._usage.items()}
+        for entry in usage.values():
+            entry['cached_ratio'] = entry['cached_tokens'] / entry['prompt_tokens'] if entry['prompt_tokens'] else 0.0
+        return usage
+
+# 全ての呼び出し元で共有する集計
+usage_tracker = PromptUsageTracker()
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import struct
+import time
+from types import SimpleNamespace
+
+from utils.openai_client import RequestPolicy, request_tokens, shared_client, shared_async_client, shared_policy
+
+# 処理ごとのモデル（環境変数 MODEL_<処理名の大文字> で変更できる）
+DEFAULT_MODELS = {
+    'analysis': 'gpt-4o-mini',     # 説明と名称を1回で取得する構造化リクエスト
+    'description': 'gpt-4o-mini',  # 説明のみ
+    'place': 'gpt-4o-mini',        # 場所の名称のみ（軽いモデルで十分）
+    'chat': 'gpt-4-turbo-preview',
+    'cli_chat': 'gpt-4o-mini',     # gpt_answer.py のコマンドラインのチャット
+    'summary': 'gpt-4o-mini',      # 長い会話の要約
+    'tts': 'tts-1'
+}
+
+def models_from_env(defaults=DEFAULT_MODELS):
+    """環境変数で上書きした処理ごとのモデル設定を返す"""
+    return {task: os.environ.get(f"MODEL_{task.upper()}", model) for task, model in defaults.items()}
+
+def gtts_speech(text, lang='ja'):
+    """gTTS で音声合成し、MP3のバイト列を返す"""
+    from gtts import gTTS
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=lang, slow=False).write_to_fp(buffer)
+    return buffer.getvalue()
+
+class Provider:
+    """LLM・音声合成の呼び出しをまとめる
+
+    呼び出し側は処理名（'chat', 'place' など）だけを指定し、使うモデルはここで決める。
+    client は OpenAI 互換のクライアント（本物の OpenAI か FakeClient）、async_client はその非同期版。
+    呼び出しには policy の処理ごとのタイムアウト・流量の制限・再試行を適用する。
+    """
+
+    def __init__(self, client, name='openai', models=None, voice='nova', tts_engine='openai',
+                 tts_fallback='none', tts_lang='ja', tts_cache=None, async_client=None, policy=None):
+        self.client = client
+        self.async_client = async_client
+        self.policy = policy or RequestPolicy()
+        self.name = name
+        self.models = dict(DEFAULT_MODELS, **(models or {}))
+        self.voice = voice
+        # 音声合成の方法（'openai' は client を使う、'gtts' は gTTS を使う）と、失敗時の代わり
+        self.tts_engine = tts_engine
+        self.tts_fallback = tts_fallback
+        self.tts_lang = tts_lang
+        self.tts_cache = tts_cache
+
+    def model(self, task):
+        return self.models[task]
+
+    def chat(self, task, messages, **kwargs):
+        """処理に応じたモデルでチャット補完を呼び出し、レスポンスをそのまま返す"""
+        model = self.model(task)
+
+        def request(timeout):
+            return self.client.chat.completions.create(model=model, messages=messages, timeout=timeout, **kwargs)
+        return self.policy.call(task, model, request, request_tokens(messages, kwargs.get('max_tokens')),
+                                stream=kwargs.get('stream', False))
+
+    async def achat(self, task, messages, **kwargs):
+        """chat の非同期版（async_client を使う）"""
+        model = self.model(task)
+
+        async def request(timeout):
+            return await self.async_client.chat.completions.create(
+                model=model, messages=messages, timeout=timeout, **kwargs
+            )
+        return await self.policy.call_async(task, model, request, request_tokens(messages, kwargs.get('max_tokens')),
+                                            stream=kwargs.get('stream', False))
+
+    def _synthesize(self, engine, text, response_format, voice):
+        if engine == 'gtts':
+            return gtts_speech(text, self.tts_lang)
+        model = self.model('tts')
+
+        def request(timeout):
+            return self.client.audio.speech.create(
+                model=model,
+                voice=voice,
+                input=text,
+                response_format=response_format,
+                timeout=timeout
+            )
+        # 音声合成の上限はリクエスト数（RPM）だけ
+        return self.policy.call('tts', model, request).content
+
+    def _cached_speech(self, engine, text, response_format, voice):
+        def synthesize():
+            return self._synthesize(engine, text, response_format, voice)
+        if not self.tts_cache:
+            return synthesize()
+        if engine == 'gtts':
+            return self.tts_cache.get_or_create(text, self.tts_lang, 'gtts', synthesize, response_format)
+        # 偽の音声が本物のキャッシュと混ざらないよう、プロバイダー名もキーに含める
+        model = self.model('tts') if self.name == 'openai' else f"{self.name}:{self.model('tts')}"
+        return self.tts_cache.get_or_create(text, voice, model, synthesize, response_format)
+
+    def speech(self, text, response_format='mp3', engine=None, voice=None):
+        """テキストを音声合成し、音声のバイト列を返す（同じテキストはキャッシュを再利用）"""
+        engine = engine or self.tts_engine
+        voice = voice or self.voice
+        try:
+            return self._cached_speech(engine, text, response_format, voice)
+        except Exception as e:
+            # gTTS は MP3 しか出力できない
+            if self.tts_fallback != 'gtts' or engine == 'gtts' or response_format != 'mp3':
+                raise
+            print(f"音声合成に失敗したため gTTS で合成します: {str(e)}")
+            return self._cached_speech('gtts', text, response_format, voice)
+
+# MPEG-1 Layer III 44.1kHz 128kbps の無音フレーム（1フレーム約26ms）
+_SILENT_MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+def fake_audio(text, response_format='mp3'):
+    """テキストの長さに応じた無音の音声を返す（1文字およそ0.1秒）"""
+    seconds = max(0.5, len(text) * 0.1)
+    if response_format == 'wav':
+        sample_rate = 8000
+        data = b'\x00\x00' * int(sample_rate * seconds)
+        return (
+            b'RIFF' + struct.pack('<I', 36 + len(data)) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+            + b'data' + struct.pack('<I', len(data)) + data
+        )
+    return _SILENT_MP3_FRAME * int(seconds / 0.026)
+
+class FakeClient:
+    """OpenAI のクライアントの代わりに、決まった応答を決まった待ち時間で返す
+
+    同じ入力には常に同じ応答を返すため、ネットワークなしで負荷試験や計測ができる。
+    待ち時間は jitter の割合だけランダムにばらつかせる（0.2 なら ±20%）。
+    """
+
+    def __init__(self, latency=0.5, token_latency=0.02, tts_latency=0.2, jitter=0.0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tts_latency = tts_latency
+        self.jitter = jitter
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(create=self._create_speech))
+
+    def _reply(self, model, messages, response_format):
+        from utils.context_manager import message_text
+        user_text = next((message_text(m) for m in reversed(messages) if m['role'] == 'user'), '')
+        digest = hashlib.sha1(f"{model}\0{user_text}".encode('utf-8')).hexdigest()
+        place = f"テスト地点{digest[:4]}"
+        description = (
+            f"ここは{place}です。これはオフライン用の応答で、内容に意味はありません。"
+            f"長い応答の処理を確かめるため、文をいくつか続けます。番号は{digest[4:10]}です。"
+        )
+        if response_format and response_format.get('type') == 'json_schema':
+            return json.dumps({'description': description, 'place': place}, ensure_ascii=False)
+        if 'この場所の名前' in user_text:
+            return place
+        return description
+
+    def delay(self, seconds):
+        """ばらつきを加えた待ち時間を返す"""
+        if not self.jitter:
+            return seconds
+        return max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _usage(self, messages, text):
+        from utils.context_manager import message_tokens, estimate_tokens
+        return SimpleNamespace(
+            prompt_tokens=sum(message_tokens(m) for m in messages),
+            completion_tokens=estimate_tokens(text),
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0)
+        )
+
+    def _pieces(self, text, size=4):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _stream_chunk(self, content):
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))], usage=None)
+
+    def _create_chat(self, model, messages, max_tokens=None, stream=False, response_format=None,
+                     extra_body=None, **kwargs):
+        text = self._reply(model, messages, response_format)
+        usage = self._usage(messages, text)
+        include_usage = bool((extra_body or {}).get('stream_options', {}).get('include_usage'))
+        time.sleep(self.delay(self.latency))
+        if not stream:
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+                usage=usage
+            )
+
+        def generate():
+            for piece in self._pieces(text):
+                time.sleep(self.delay(self.token_latency))
+                yield self._stream_chunk(piece)
+            if include_usage:
+                yield SimpleNamespace(choices=[], usage=usage)
+        return generate()
+
+    def _create_speech(self, model, voice, input, response_format='mp3', **kwargs):
+        time.sleep(self.delay(self.tts_latency))
+        return SimpleNamespace(content=fake_audio(input, response_format))
+
+class FakeAsyncClient:
+    """FakeClient の非同期版（AsyncOpenAI の代わり）"""
+
+    def __init__(self, fake_client):
+        self.fake_client = fake_client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+
+    async def _create_chat(self, model, messages, stream=False, response_format=None, extra_body=None, **kwargs):
+        fake = self.fake_client
+        text = fake._reply(model, messages, response_format)
+        usage = fake._usage(messages, text)
+        include_usage = bool((extra_body or {}).get('stream_options', {}).get('include_usage'))
+        await asyncio.sleep(fake.delay(fake.latency))
+        if not stream:
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+                usage=usage
+            )
+
+        async def generate():
+            for piece in fake._pieces(text):
+                await asyncio.sleep(fake.delay(fake.token_latency))
+                yield fake._stream_chunk(piece)
+            if include_usage:
+                yield SimpleNamespace(choices=[], usage=usage)
+        return generate()
+
+def create_provider(api_key=None, tts_cache=None):
+    """環境変数の設定に従って Provider を作る
+
+    LLM_PROVIDER=fake でネットワークを使わない FakeClient を使う
+    （待ち時間は FAKE_LLM_LATENCY / FAKE_TOKEN_LATENCY / FAKE_TTS_LATENCY 秒、ばらつきは FAKE_LATENCY_JITTER）。
+    流量の制限はプロセス内の全ての Provider で共有する（設定は utils.openai_client.policy_from_env）。
+    """
+    name = os.environ.get('LLM_PROVIDER', 'openai')
+    if name == 'fake':
+        client = FakeClient(
+            latency=float(os.environ.get('FAKE_LLM_LATENCY', 0.5)),
+            token_latency=float(os.environ.get('FAKE_TOKEN_LATENCY', 0.02)),
+            tts_latency=float(os.environ.get('FAKE_TTS_LATENCY', 0.2)),
+            jitter=float(os.environ.get('FAKE_LATENCY_JITTER', 0))
+        )
+        async_client = FakeAsyncClient(client)
+    elif name == 'openai':
+        # 接続プールはプロセス内で共有する
+        client = shared_client(api_key)
+        async_client = shared_async_client(api_key)
+    else:
+        raise ValueError(f"不明なプロバイダーです: {name}")
+
+    return Provider(
+        client,
+        name=name,
+        models=models_from_env(),
+        voice=os.environ.get('TTS_VOICE', 'nova'),
+        tts_engine=os.environ.get('TTS_PROVIDER', 'openai'),
+        # gTTS は requirements.txt に含めていないため、代わりに使うには TTS_FALLBACK=gtts を指定する
+        tts_fallback=os.environ.get('TTS_FALLBACK', 'none'),
+        tts_cache=tts_cache,
+        async_client=async_client,
+        policy=shared_policy()
+    )
@@ -0,0 +1,125 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from utils.audio_transcoder import CONCATENABLE_FORMATS
+from utils.capture_ids import atomic_write
+
+# 文の区切り（句点・感嘆符・疑問符・改行）。閉じ括弧は直前の文に含める
+SENTENCE_END = re.compile(r'[。！？!?\n]+[」』）)]*')
+
+def split_sentences(text):
+    """テキストを文単位に分割する"""
+    chunker = SentenceChunker()
+    return chunker.feed(text) + chunker.flush()
+
+class SentenceChunker:
+    """ストリーミングで届くテキストを、文が完成した時点で切り出す"""
+
+    def __init__(self, min_length=8):
+        # 短すぎる文（「はい。」など）は次の文とまとめて1回の音声合成にする
+        self.min_length = min_length
+        self.buffer = ''
+
+    def feed(self, text):
+        """テキストを追加し、完成した文のリストを返す"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            # 区切り文字がバッファの末尾にある場合、閉じ括弧が続くかもしれないので待つ
+            if match.end() == len(self.buffer) and self.buffer[-1] not in '」』）)':
+                break
+            sentence = self.buffer[start:match.end()]
+            if len(sentence.strip()) < self.min_length:
+                continue
+            sentences.append(sentence.strip())
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """残りのテキストを最後の文として返す"""
+        rest = self.buffer.strip()
+        self.buffer = ''
+        return [rest] if rest else []
+
+class SynthesizedAudio:
+    """複数の音声チャンクを連結したもの（OpenAIの音声レスポンスと同じ使い方ができる）"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.content = b''.join(chunks)
+
+    def stream_to_file(self, path):
+        atomic_write(path, self.content)
+
+class SpeechPipeline:
+    """文ごとの音声合成を並列数を制限して実行し、元の順番で結果を取り出す"""
+
+    def __init__(self, provider, max_workers=3, response_format='mp3'):
+        self.provider = provider
+        self.response_format = response_format
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _synthesize(self, text):
+        return self.provider.speech(text, response_format=self.response_format)
+
+    def submit(self, text):
+        """1文の音声合成を開始し、音声バイト列を返す Future を返す"""
+        return self.executor.submit(self._synthesize, text)
+
+    def synthesize(self, text):
+        """テキストを文ごとに並列で音声合成し、連結した音声を返す"""
+        if self.response_format not in CONCATENABLE_FORMATS:
+            # 連結できない形式（Ogg/Opus など）は全文を1回で合成する
+            return SynthesizedAudio([self._synthesize(text)])
+        futures = [self.submit(sentence) for sentence in split_sentences(text)]
+        return SynthesizedAudio([future.result() for future in futures])
+
+    def stream(self):
+        """ストリーミング中のテキストを順に受け取り、音声を順番どおりに取り出すためのキュー"""
+        return SpeechQueue(self)
+
+    def start(self, text):
+        """テキスト全体の文ごとの音声合成を開始し、結果を順番どおりに取り出すキューを返す
+
+        文ごとの音声は連結せずに別々のファイルとして使う（最初の文から再生を始められる）。
+        """
+        queue = self.stream()
+        queue.feed(text)
+        queue.close()
+        return queue
+
+class SpeechQueue:
+    """ストリーミングされたテキストの文ごとの音声合成結果を、順番どおりに取り出す"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.chunker = SentenceChunker()
+        self.pending = []
+        self.next_index = 0
+
+    def feed(self, text):
+        """テキストを追加し、完成した文の音声合成を開始する"""
+        for sentence in self.chunker.feed(text):
+            self.pending.append(self.pipeline.submit(sentence))
+
+    def close(self):
+        """残りのテキストの音声合成を開始する"""
+        for sentence in self.chunker.flush():
+            self.pending.append(self.pipeline.submit(sentence))
+
+    def results(self):
+        """完了を待ちながら、先頭から順に (番号, 音声バイト列) を返す"""
+        while self.pending:
+            content = self.pending.pop(0).result()
+            index = self.next_index
+            self.next_index += 1
+            yield index, content
+
+    def ready(self, wait=False):
+        """先頭から順に完了した (番号, 音声バイト列) を返す（wait=True なら全件完了まで待つ）"""
+        results = []
+        while self.pending and (wait or self.pending[0].done()):
+            results.append((self.next_index, self.pending.pop(0).result()))
+            self.next_index += 1
+        return results
@@ -0,0 +1,225 @@
+import json
+import os
+import sqlite3
+import threading
+
+from utils.metadata_manager import JsonMetadataStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT,
+    image_path TEXT,
+    filename TEXT,
+    place_name TEXT,
+    latitude REAL,
+    longitude REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_image_path ON images(image_path);
+CREATE INDEX IF NOT EXISTS idx_images_filename ON images(filename);
+CREATE INDEX IF NOT EXISTS idx_images_timestamp_id ON images(timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_images_place_name ON images(place_name);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class SqliteMetadataStore:
+    """SQLite(WALモード)に画像メタデータを保存するバックエンド
+
+    画像データ全体は data 列にJSONで保持し、検索に使う項目だけを列として持つ。
+    複数の gunicorn ワーカーから同時に書き込んでも更新が失われない。
+    """
+
+    def __init__(self, db_file, json_file=None, timeout=30.0):
+        self.db_file = db_file
+        self.timeout = timeout
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._upgrade_schema(conn)
+
+        if json_file:
+            self.migrate_from_json(json_file)
+
+    def _upgrade_schema(self, conn):
+        """以前のバージョンで作成したデータベースに不足している列・索引を追加する"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(images)')}
+        if 'latitude' not in columns:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(images)')}
+                if 'latitude' not in columns:
+                    conn.execute('ALTER TABLE images ADD COLUMN latitude REAL')
+                    conn.execute('ALTER TABLE images ADD COLUMN longitude REAL')
+                    conn.execute(
+                        "UPDATE images SET latitude = json_extract(data, '$.latitude'), "
+                        "longitude = json_extract(data, '$.longitude')"
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_location ON images(latitude, longitude)')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_audio_path ON images(json_extract(data, '$.audio_path'))")
+
+    def _connect(self):
+        """スレッドごとに接続を使い回す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    def _row(self, image_id, image_data):
+        image_path = image_data.get('image_path', '')
+        return (
+            image_id,
+            image_data.get('timestamp', ''),
+            image_path,
+            os.path.basename(image_path),
+            image_data.get('place_name'),
+            _float_or_none(image_data.get('latitude')),
+            _float_or_none(image_data.get('longitude')),
+            json.dumps(image_data, ensure_ascii=False)
+        )
+
+    def _insert(self, conn, rows, replace=True):
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        conn.executemany(
+            f"{verb} INTO images (id, timestamp, image_path, filename, place_name, latitude, longitude, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    def _bump_version(self, conn):
+        """書き込みのたびに更新番号を進める（トランザクション内で呼ぶ）"""
+        conn.execute(
+            "INSERT INTO store_meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def migrate_from_json(self, json_file):
+        """既存の metadata.json の内容を一度だけ取り込む"""
+        if not os.path.exists(json_file):
+            return 0
+
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM store_meta WHERE key = 'migrated_from_json'").fetchone():
+            return 0
+
+        metadata = JsonMetadataStore(json_file).load_all()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 他のワーカーが先に移行を終えていないか、ロック取得後に再確認する
+            if conn.execute("SELECT 1 FROM store_meta WHERE key = 'migrated_from_json'").fetchone():
+                conn.execute('ROLLBACK')
+                return 0
+            self._insert(conn, [self._row(image_id, data) for image_id, data in metadata.items()], replace=False)
+            conn.execute(
+                "INSERT INTO store_meta (key, value) VALUES ('migrated_from_json', ?)",
+                (json_file,)
+            )
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(metadata)
+
+    # --- ストレージAPI ---
+
+    def load_all(self):
+        """全件を {画像ID: 画像データ} で取得"""
+        rows = self._connect().execute('SELECT id, data FROM images')
+        return {image_id: json.loads(data) for image_id, data in rows}
+
+    def replace_all(self, metadata):
+        """全件を置き換える"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM images')
+            self._insert(conn, [self._row(image_id, data) for image_id, data in metadata.items()])
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def put(self, image_id, image_data):
+        """1件を追加（既存IDは上書き）"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._insert(conn, [self._row(image_id, image_data)])
+            self._bump_version(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, image_id):
+        row = self._connect().execute('SELECT data FROM images WHERE id = ?', (image_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_filename(self, filename):
+        row = self._connect().execute(
+            'SELECT data FROM images WHERE filename = ? LIMIT 1',
+            (os.path.basename(filename),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_by_timestamp(self, reverse=True):
+        """撮影日時順に (画像ID, 画像データ) のリストを取得"""
+        order = 'DESC' if reverse else 'ASC'
+        rows = self._connect().execute(f'SELECT id, data FROM images ORDER BY timestamp {order}, id {order}')
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def list_page(self, limit, cursor=None):
+        """新しい順に、cursor=(タイムスタンプ, 画像ID) より前の limit 件を取得"""
+        conn = self._connect()
+        if cursor:
+            rows = conn.execute(
+                'SELECT id, data FROM images WHERE (timestamp, id) < (?, ?) '
+                'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                (cursor[0], cursor[1], limit)
+            )
+        else:
+            rows = conn.execute('SELECT id, data FROM images ORDER BY timestamp DESC, id DESC LIMIT ?', (limit,))
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def list_near(self, min_lat, max_lat, min_lng, max_lng):
+        """緯度・経度の範囲内にある (画像ID, 画像データ) のリストを取得"""
+        rows = self._connect().execute(
+            'SELECT id, data FROM images WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?',
+            (min_lat, max_lat, min_lng, max_lng)
+        )
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def list_by_audio_path(self, audio_path):
+        """指定の音声ファイルを参照している (画像ID, 画像データ) のリストを取得（文ごとの音声も含む）"""
+        rows = self._connect().execute(
+            "SELECT id, data FROM images WHERE json_extract(data, '$.audio_path') = ? "
+            "OR EXISTS (SELECT 1 FROM json_each(data, '$.audio_chunks') WHERE value = ?)",
+            (audio_path, audio_path)
+        )
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def version(self):
+        """内容が変わると値が変わるトークン（キャッシュの無効化判定用）"""
+        row = self._connect().execute("SELECT value FROM store_meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
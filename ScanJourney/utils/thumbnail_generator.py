@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+
+from PIL import Image, ImageOps, features
+
+from utils.capture_ids import new_capture_id
+
+# 形式 -> 拡張子
+THUMBNAIL_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
+
+class ThumbnailGenerator:
+    """アルバム表示用に複数サイズのサムネイル(JPEG/WebP)を生成する
+
+    ファイル名には元画像の内容ハッシュを含めるため、同じ名前のファイルの中身は変わらない。
+    そのため長期間のブラウザキャッシュを許可できる。
+    ファイルは thumbs/<ハッシュの先頭2桁>/ に分けて置く（返す名前は output_folder からの相対パス）。
+    store（MediaStore）を指定した場合は、生成したファイルをストアへ移し、ストアの参照を返す。
+    ストアのキーは元画像と生成の設定から決めるので、保存済みのサムネイルは作り直さない。
+    """
+
+    def __init__(self, output_folder, widths=(200, 400, 800), jpeg_quality=80, webp_quality=75, store=None):
+        self.output_folder = output_folder
+        self.store = store
+        self.widths = tuple(sorted(widths))
+        self.jpeg_quality = jpeg_quality
+        self.webp_quality = webp_quality
+        self.webp_enabled = features.check('webp')
+
+    def content_hash(self, image_file):
+        """画像ファイルの内容ハッシュ（先頭16桁）"""
+        return self._file_digest(image_file)[:16]
+
+    def _file_digest(self, image_file):
+        digest = hashlib.sha256()
+        with open(image_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _filename(self, content_hash, width, ext):
+        return f"thumbs/{content_hash[:2]}/thumb_{content_hash}_{width}.{ext}"
+
+    def _path(self, filename):
+        return os.path.join(self.output_folder, *filename.split('/'))
+
+    def _store_digest(self, file_digest, width, ext):
+        """ストアに保存するサムネイルのキー（元画像と生成の設定から決まるので、作る前に保存済みか確かめられる）"""
+        quality = self.jpeg_quality if ext == 'jpg' else self.webp_quality
+        return hashlib.sha256(f"thumb:{file_digest}:{width}:{ext}:{quality}".encode()).hexdigest()
+
+    def generate(self, image_file):
+        """サムネイルを生成し、[{'width', 'jpeg', 'webp'}, ...] を返す（生成済みなら再利用）"""
+        file_digest = self._file_digest(image_file)
+        content_hash = file_digest[:16]
+        if not self.store:
+            os.makedirs(os.path.dirname(self._path(self._filename(content_hash, 0, 'jpg'))), exist_ok=True)
+
+        thumbnails = []
+        with Image.open(image_file) as original:
+            # 元画像より大きいサイズは作らない（最小サイズは必ず作る）。
+            # 回転しても幅と高さが入れ替わるだけなので、縮小前の判定は EXIF の向きを反映した大きさで行う
+            width_limit = original.height if original.getexif().get(0x0112, 1) in (5, 6, 7, 8) else original.width
+            widths = [w for w in self.widths if w < width_limit] or [min(self.widths[0], width_limit)]
+            img = None
+
+            for width in widths:
+                entry = {'width': width, 'jpeg': self._filename(content_hash, width, 'jpg'), 'webp': None}
+                if self.webp_enabled:
+                    entry['webp'] = self._filename(content_hash, width, 'webp')
+
+                if self.store:
+                    targets = {
+                        fmt: self._store_digest(file_digest, width, ext)
+                        for fmt, ext in THUMBNAIL_EXTENSIONS.items() if entry[fmt]
+                    }
+                    keys = {fmt: self.store.key_for(digest, THUMBNAIL_EXTENSIONS[fmt]) for fmt, digest in targets.items()}
+                    if all(self.store.contains(key) for key in keys.values()):
+                        # 保存済みなら作り直さない
+                        entry.update({fmt: self.store.url(key) for fmt, key in keys.items()})
+                        thumbnails.append(entry)
+                        continue
+                    # ストアへ移すため、他のスレッドと重ならない一時ファイルに書き出す
+                    temp_name = f"thumb_{new_capture_id()}"
+                    jpeg_path = self.store.incoming_path(f"{temp_name}.jpg")
+                    webp_path = self.store.incoming_path(f"{temp_name}.webp") if entry['webp'] else None
+                else:
+                    jpeg_path = self._path(entry['jpeg'])
+                    webp_path = self._path(entry['webp']) if entry['webp'] else None
+                    if os.path.exists(jpeg_path) and (not webp_path or os.path.exists(webp_path)):
+                        thumbnails.append(entry)
+                        continue
+
+                if img is None:
+                    # EXIFの回転情報を反映してから縮小する
+                    img = ImageOps.exif_transpose(original)
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
+                height = max(1, round(img.height * width / img.width))
+                resized = img.resize((width, height), Image.Resampling.LANCZOS)
+                self._save(resized, jpeg_path, 'JPEG', quality=self.jpeg_quality, optimize=True, progressive=True)
+                if webp_path:
+                    self._save(resized, webp_path, 'WEBP', quality=self.webp_quality, method=4)
+
+                if self.store:
+                    entry['jpeg'] = self.store.put_file(jpeg_path, digest=targets['jpeg'])
+                    if webp_path:
+                        entry['webp'] = self.store.put_file(webp_path, digest=targets['webp'])
+                thumbnails.append(entry)
+
+        return thumbnails
+
+    def _save(self, img, path, fmt, **options):
+        """一時ファイルに書き出してからリネームする（書き込み途中のファイルを配信しない）"""
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        img.save(tmp_path, format=fmt, **options)
+        os.replace(tmp_path, path)
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+def normalize_text(text):
+    """キャッシュキー用にテキストを正規化する（全角半角の統一・空白の整理）"""
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+class TTSCache:
+    """(テキスト, 声, モデル) をキーに、合成済み音声をディスクへ保存するキャッシュ
+
+    ファイルは内容のハッシュ名で保存し、合計サイズが上限を超えたら
+    最も長く使われていないものから削除する。
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, extension='mp3'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # キー -> ファイルサイズ（古い順）
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """既存のキャッシュファイルを最終利用日時順に読み込む"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(f".{self.extension}"):
+                    continue
+                st = os.stat(os.path.join(dirpath, filename))
+                entries.append((st.st_mtime, filename[:-len(self.extension) - 1], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def key(self, text, voice, model, response_format='mp3'):
+        payload = f"{model}\0{voice}\0{response_format}\0{normalize_text(text)}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{self.extension}")
+
+    def get(self, key):
+        """キャッシュされた音声を返す（なければ None）"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            # 他プロセスに削除された場合
+            with self._lock:
+                if key in self._index:
+                    self._total_bytes -= self._index.pop(key)
+            return None
+
+        # 最終利用日時を更新し、他プロセスから見ても新しい扱いにする
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if key not in self._index:
+                # 他プロセスが作成したファイル
+                self._total_bytes += len(content)
+            self._index[key] = len(content)
+            self._index.move_to_end(key)
+        return content
+
+    def put(self, key, content):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index[key]
+            self._index[key] = len(content)
+            self._index.move_to_end(key)
+            self._total_bytes += len(content)
+            self._evict()
+
+    def _evict(self):
+        """上限を超えた分を古い順に削除する（ロック取得済みで呼ぶ）"""
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def get_or_create(self, text, voice, model, synthesize, response_format='mp3'):
+        """キャッシュがあれば返し、なければ synthesize() で作成して保存する"""
+        key = self.key(text, voice, model, response_format)
+        content = self.get(key)
+        if content is not None:
+            with self._lock:
+                self.hits += 1
+            return content
+
+        with self._lock:
+            self.misses += 1
+        content = synthesize()
+        self.put(key, content)
+        return content
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._index),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes
+            }